@@ -3,19 +3,29 @@
 A command line interface to HabitRPG.
 """
 
+# Answer shell completion requests before any of the heavier imports below
+from habitcli.complete import autocomplete, write_index
+autocomplete()
+
 # Standard library imports
+import ConfigParser
+import argparse
 import collections
 import datetime
+import os
 import sys
 import textwrap
-from collections import defaultdict
+import threading
+import time
+from collections import OrderedDict, defaultdict
+from contextlib import contextmanager
 from itertools import groupby
 
 # Third party imports
 import argh
 import colors
 import dateutil.parser
-from argh.decorators import named
+from argh.decorators import arg, named
 from tzlocal import get_localzone
 from requests import ConnectionError
 from fuzzywuzzy import process
@@ -23,11 +33,32 @@ from fuzzywuzzy import process
 # Same-project imports
 import habitcli.gui
 import habitcli.pretty as pretty
-from pyhabit import HabitAPI
+from habitcli.agenda import bucket_by_day, day_boundaries, parse_day
+from habitcli.asyncapi import AsyncHabitAPI, wait_all
+from habitcli.cassette import CassetteRecorder, RecordingHabitAPI
+from habitcli.cassette import ReplayHabitAPI
+from habitcli.changes import ChangeFeed
+from habitcli.dedupe import find_duplicates, merge_checklists
+from habitcli.history import StatsHistory, parse_duration, sparkline
+from habitcli.importer import TodoImporter, read_records, format_summary
+from habitcli.query import TodoIndex, compile_query, run_query
+from habitcli.ratelimit import AdaptiveLimiter, ThrottledHabitAPI
+from habitcli.ratelimit import DEFAULT_TIMEOUT
+from habitcli.remind import ReminderQueue, notify
+from habitcli.search import SearchIndex, get_search_index
+from habitcli.search import update_search_index
+from habitcli.startup import BackgroundFetch
+from habitcli.watch import redraw, write_atomic
 from habitcli.exceptions import MultipleTasksException, NoSuchTagException
+from habitcli.exceptions import DateParseException, HabitAPIError
 from habitcli.utils import confirm, serialize_date, deserialize_date
 from habitcli.utils import parse_datetime, read_config
 from habitcli.utils import get_default_config_filename, save_user, load_user
+from habitcli.utils import get_config_mtime, get_user_cache_stat
+from habitcli.utils import load_snapshot, save_snapshot
+from habitcli.utils import load_archive, save_archive, has_archive
+from habitcli.utils import archive_hash
+from habitcli.utils import list_profiles
 
 
 class Todo(collections.MutableMapping):
@@ -37,16 +68,29 @@ class Todo(collections.MutableMapping):
     def __init__(self, *args, **kwargs):
         self.hcli = kwargs.pop('hcli', None)
         self.store = dict(*args, **kwargs)
+        # Memoized values derived from the store, e.g. the parsed dates
+        self.derived = {}
         if 'tags' not in self:
             self['tags'] = {}
 
+    @classmethod
+    def restore(cls, store, derived, hcli):
+        """Rebuild a todo from a snapshot without copying its store."""
+        todo = cls.__new__(cls)
+        todo.hcli = hcli
+        todo.store = store
+        todo.derived = derived
+        return todo
+
     def __getitem__(self, key):
         return self.store[key]
 
     def __setitem__(self, key, value):
+        self.derived.clear()
         self.store[key] = value
 
     def __delitem__(self, key):
+        self.derived.clear()
         del self.store[key]
 
     def __iter__(self):
@@ -61,7 +105,9 @@ class Todo(collections.MutableMapping):
 
     def get_planning_date(self):
         """Extract the planning due date string from the task."""
-        planned_date = deserialize_date(self['notes'])
+        if 'plan_date' not in self.derived:
+            self.derived['plan_date'] = deserialize_date(self['notes'])
+        planned_date = self.derived['plan_date']
 
         if planned_date:
             return planned_date
@@ -80,12 +126,15 @@ class Todo(collections.MutableMapping):
 
     def get_due_date(self):
         """Extract the due date from the task as a datetime."""
-        if 'date' in self.keys() and self['date']:
-            return dateutil.parser.parse(self['date'])
-        elif 'dateCompleted' in self.keys() and self['dateCompleted']:
-            return dateutil.parser.parse(self['dateCompleted'])
-        else:
-            return None
+        if 'due_date' not in self.derived:
+            if 'date' in self.keys() and self['date']:
+                due_date = dateutil.parser.parse(self['date'])
+            elif 'dateCompleted' in self.keys() and self['dateCompleted']:
+                due_date = dateutil.parser.parse(self['dateCompleted'])
+            else:
+                due_date = None
+            self.derived['due_date'] = due_date
+        return self.derived['due_date']
 
     def set_due_date(self, due_date, update=False):
         """Set the due date."""
@@ -98,6 +147,9 @@ class Todo(collections.MutableMapping):
         Get the primary tag of a todo. Each todo should have a single task tag,
         although it may have further decorative tags.
         """
+        if 'primary_tag' in self.derived:
+            return self.derived['primary_tag']
+
         tag_strs = [self.hcli.get_user()['tag_dict'][t]
                     for t in self['tags'].keys()
                     if self['tags'][t]]
@@ -108,15 +160,17 @@ class Todo(collections.MutableMapping):
             raise MultipleTasksException(self['id'], primary_tags)
 
         if primary_tags:
-            return primary_tags[0]
+            self.derived['primary_tag'] = primary_tags[0]
         else:
-            return None
+            self.derived['primary_tag'] = None
+        return self.derived['primary_tag']
 
     def set_primary_tag(self, tag, update=False):
         """
         Set the primary tag of a todo. This will unset any other primary tags
         currently applied.
         """
+        self.derived.clear()
         for task_id in [self.hcli.get_user()['reverse_tag_dict'][t]
                         for t in self.hcli.config['tasks']]:
             if self['tags'].get(task_id):
@@ -145,8 +199,13 @@ class Todo(collections.MutableMapping):
     def update_db(self):
         """
         Call the HabitRPG API to update self, then replace self with the
-        returned values.
+        returned values. Inside HabitCLI.batch(), the update is deferred to
+        the end of the batch instead.
         """
+        pending = getattr(self.hcli, 'pending_updates', None)
+        if pending is not None:
+            pending[self['id']] = self
+            return
         updated_self = self.hcli.api.update_task(self['id'], dict(self))
         self._update(updated_self)
 
@@ -170,12 +229,71 @@ class Todo(collections.MutableMapping):
         """
         self.hcli.api.delete_task(self['id'])
 
+    # Asynchronous counterparts of the mutators above. Each returns an
+    # AsyncResult immediately and updates self once the response arrives.
+
+    def update_db_async(self):
+        """Queue an update of self on the HabitRPG database."""
+        return self.hcli.get_async_api().update_task(self['id'], dict(self),
+                                                     callback=self._update)
+
+    def complete_async(self):
+        """Queue marking self as completed."""
+        async_api = self.hcli.get_async_api()
+        return async_api.perform_task(self['id'], async_api.DIRECTION_UP,
+                                      callback=self._update)
+
+    def create_async(self):
+        """Queue creating the task on the HabitRPG database."""
+        return self.hcli.get_async_api().create_todo(dict(self),
+                                                     callback=self._update)
+
+    def delete_async(self):
+        """Queue deleting the task from the HabitRPG database."""
+        return self.hcli.get_async_api().delete_task(self['id'])
+
+
+# The top-level fields of the user document that habitcli reads
+USER_FIELDS = ['todos', 'habits', 'dailys', 'tags', 'stats', 'err']
+
+
+def get_drops(responses):
+    """Collect the item drops reported in scoring responses."""
+    return [response['_tmp']['drop'] for response in responses
+            if 'drop' in response.get('_tmp', {})]
+
+
+def is_archived(todo):
+    """Completed todos belong in the cold archive."""
+    return bool(todo.get('completed'))
+
 
 class HabitCLI(object):
     """A class incorporating everything necessary to interact with HabitRPG."""
-    def __init__(self):
-        """Initialize the CLI object."""
-        self.config = read_config()
+    def __init__(self, config_filename=None, profile=None, read_only=False):
+        """
+        Initialize the CLI object for the given profile in the config.
+        'read_only' lets startup settle for the cached user if the network
+        is slow.
+        """
+        self.config_filename = config_filename or \
+            get_default_config_filename()
+        self.profile = profile
+        self.read_only = read_only
+        self.pending_updates = None
+        self.snapshot = load_snapshot(profile)
+        if self._snapshot_config_matches():
+            self.config = self.snapshot['config']
+        else:
+            try:
+                self.config = read_config(config_filename, profile)
+            except ConfigParser.NoSectionError:
+                profiles = [name for name
+                            in list_profiles(self.config_filename) if name]
+                print "No profile '%s' in %s. Configured profiles: %s" % \
+                    (profile, self.config_filename,
+                     ", ".join(profiles) if profiles else "none")
+                sys.exit(1)
         self.api = self._get_api()
         self.user = self.get_user()
 
@@ -188,52 +306,318 @@ class HabitCLI(object):
             user_id = self.config["user_id"]
         if not api_key:
             api_key = self.config["api_key"]
-        self.api = HabitAPI(user_id, api_key)
+        limiter = AdaptiveLimiter(
+            rate=float(self.config.get("rate_limit", 5.0)),
+            max_concurrency=int(self.config.get("max_concurrency", 8)))
+        kwargs = {'limiter': limiter,
+                  'max_retries': int(self.config.get("max_retries", 2)),
+                  'timeout': float(self.config.get("timeout",
+                                                   DEFAULT_TIMEOUT))}
+        if self.config.get("api_url"):
+            kwargs['base_url'] = self.config["api_url"]
+
+        # Replay or record API traffic, selected by environment or config
+        replay = os.environ.get('HABIT_REPLAY', self.config.get("replay"))
+        record = os.environ.get('HABIT_RECORD', self.config.get("record"))
+        if replay:
+            speed = os.environ.get('HABIT_REPLAY_SPEED',
+                                   self.config.get("replay_speed", 0))
+            self.api = ReplayHabitAPI(user_id, api_key,
+                                      cassette=os.path.expanduser(replay),
+                                      speed=float(speed), **kwargs)
+        elif record:
+            recorder = CassetteRecorder(os.path.expanduser(record),
+                                        keep=self.config['tasks'])
+            self.api = RecordingHabitAPI(user_id, api_key, recorder=recorder,
+                                         **kwargs)
+        else:
+            self.api = ThrottledHabitAPI(user_id, api_key, **kwargs)
         return self.api
 
+    def is_replaying(self):
+        """True if the API traffic is served from a cassette."""
+        return getattr(self._get_api(), 'replaying', False)
+
+    def get_async_api(self):
+        """Get the concurrent API client, sharing the api's limiter."""
+        if not getattr(self, 'async_api', None):
+            concurrency = int(self.config.get("max_concurrency", 8))
+            try:
+                self.async_api = AsyncHabitAPI.from_api(
+                    self._get_api(), concurrency=concurrency)
+            except ValueError as err:
+                print err
+                sys.exit(1)
+        return self.async_api
+
+    @contextmanager
+    def batch(self):
+        """
+        Defer the todo updates made in the block, then send each changed
+        todo once with all of its changes, so several edits to one todo cost
+        a single request. Nothing is sent if the block raises.
+        """
+        if self.pending_updates is not None:
+            # Nested batches are flushed by the outermost one
+            yield
+            return
+        self.pending_updates = OrderedDict()
+        try:
+            yield
+            pending = self.pending_updates
+            self.pending_updates = None
+            self._flush_updates(pending.values())
+        finally:
+            self.pending_updates = None
+
+    def _flush_updates(self, todos):
+        """Send the updates of several todos, concurrently if need be."""
+        if len(todos) == 1:
+            todos[0].update_db()
+            return
+        results = [todo.update_db_async() for todo in todos]
+        errors = [err for _, err in wait_all(results) if err]
+        if errors:
+            raise errors[0]
+
     def get_user(self, refresh=False):
-        """Get the user object from HabitRPG (if possible) or the cache."""
+        """
+        Get the user object from HabitRPG (if possible) or the cache.
+
+        The cache is loaded while the user is being fetched. Read-only
+        commands fall back to it if the fetch takes longer than the
+        'startup_deadline' in the config; otherwise the fetched user wins.
+        A user replayed from a cassette is kept apart from the cache.
+        """
         if not refresh and hasattr(self, 'user') and self.user:
             return self.user
         else:
-            try:
-                self.user = self.api.user()
-                save_user(self.user)
-                self.user['cached'] = False
-            except ConnectionError:
-                self.user = load_user()
-                self.user['cached'] = True
-
-            if 'err' in self.user.keys():
+            replaying = self.is_replaying()
+            save_late = lambda raw_user: save_user(raw_user, self.profile)
+            fetch = BackgroundFetch(
+                lambda: self.api.user(fields=USER_FIELDS),
+                on_late=None if replaying else save_late)
+            started = time.time()
+
+            # Meanwhile, find the cached user: the snapshot is enough if it
+            # was built from the current cache file
+            cached_hash = None
+            cached_user = None
+            if replaying:
+                pass
+            elif self._snapshot_matches(
+                    cache_stat=get_user_cache_stat(self.profile)):
+                cached_hash = self.snapshot['user_hash']
+            else:
+                try:
+                    cached_user = load_user(self.profile)
+                except Exception:  # pylint: disable=broad-except
+                    # A missing or unreadable cache is as good as none
+                    pass
+
+            timeout = None
+            if self.read_only and (cached_hash or cached_user is not None):
+                deadline = float(self.config.get("startup_deadline", 2.0))
+                timeout = max(0.0, deadline - (time.time() - started))
+            raw_user = None
+            if fetch.wait(timeout):
+                try:
+                    raw_user = fetch.get()
+                except ConnectionError:
+                    pass
+            cached = raw_user is None
+
+            if raw_user is not None and 'err' in raw_user.keys():
                 print "Error '%s': Is the configuration in %s correct?" % \
-                    (self.user['err'], get_default_config_filename())
+                    (raw_user['err'], self.config_filename)
+                sys.exit(1)
+
+            if raw_user is not None and replaying:
+                user_hash = None
+            elif raw_user is not None:
+                user_hash = save_user(raw_user, self.profile)
+            elif cached_hash:
+                user_hash = cached_hash
+            elif cached_user is not None:
+                raw_user = cached_user
+                user_hash = None
+            else:
+                print "Could not reach HabitRPG and there is no cached user."
                 sys.exit(1)
 
-            # Replace user['todos'] with todo objects
-            for index, todo in enumerate(self.user['todos']):
-                self.user['todos'][index] = Todo(todo, hcli=self)
-
-            # Add tag dictionaries to the user object
-            tag_dict = defaultdict(lambda: "+missingtag")
-            reverse_tag_dict = defaultdict(unicode)
-            color_dict = defaultdict(lambda: lambda x: x)
-            for tag in [tag for tag in self.user['tags']
-                        if tag['name'] in self.config['tasks']]:
-                tag_dict[tag['id']] = tag['name']
-                reverse_tag_dict[tag['name']] = tag['id']
-
-                if tag['name'] in self.config['taskcolors'].keys():
-                    if self.config['taskcolors'][tag['name']] in colors.COLORS:
-                        color = getattr(colors,
-                                        self.config['taskcolors'][tag['name']])
-                        color_dict[tag['name']] = color
-                        color_dict[tag['id']] = color
-
-            self.user['tag_dict'] = tag_dict
-            self.user['reverse_tag_dict'] = reverse_tag_dict
-            self.user['color_dict'] = color_dict
+            archive_changed = False
+            if self._snapshot_matches(user_hash=user_hash):
+                self._restore_snapshot()
+            else:
+                old_archive_hash = (self.snapshot.get('archive_hash')
+                                    if self.snapshot else None)
+                self._build_user(raw_user)
+                if user_hash:
+                    # Completed todos rarely change, so skip rewriting the
+                    # archive unless its content did
+                    archive_changed = (self.archive_hash != old_archive_hash or
+                                       not has_archive(self.profile))
+                    if archive_changed:
+                        save_archive(self.archive, self.profile)
+                    self._save_snapshot(user_hash)
+            self.user['cached'] = cached
+
+            if not self.user['cached'] and not replaying:
+                if getattr(self, 'archive', None) is not None:
+                    if archive_changed:
+                        update_search_index(self.user['todos'] + self.archive,
+                                            self.profile)
+                    else:
+                        update_search_index(
+                            self.user['todos'], self.profile,
+                            unchanged=[todo['id'] for todo in self.archive])
+                    ChangeFeed(self.profile).publish(
+                        self.user['todos'] + self.archive, self.user['stats'],
+                        self.config.get('change_hook'))
+                write_index(self.user, self.profile)
+                StatsHistory(profile=self.profile).append(self.user['stats'])
             return self.user
 
+    def _build_user(self, raw_user):
+        """Wrap the todos and add the tag dictionaries to a raw user."""
+        self.user = raw_user
+
+        # Move completed todos to the cold archive, and replace the active
+        # ones in user['todos'] with todo objects
+        self.archive = [todo for todo in self.user['todos']
+                        if is_archived(todo)]
+        self.archive_hash = archive_hash(self.archive)
+        self.archived_todos = None
+        self.todo_index = None
+        self.user['todos'] = [Todo(todo, hcli=self)
+                              for todo in self.user['todos']
+                              if not is_archived(todo)]
+
+        # Add tag dictionaries to the user object
+        tag_dict = {}
+        color_names = {}
+        for tag in [tag for tag in self.user['tags']
+                    if tag['name'] in self.config['tasks']]:
+            tag_dict[tag['id']] = tag['name']
+
+            if tag['name'] in self.config['taskcolors'].keys():
+                if self.config['taskcolors'][tag['name']] in colors.COLORS:
+                    color_name = self.config['taskcolors'][tag['name']]
+                    color_names[tag['name']] = color_name
+                    color_names[tag['id']] = color_name
+
+        self._add_tag_dicts(tag_dict, color_names)
+
+    def get_tag_ids(self, tags):
+        """
+        Return the IDs of the given tag names, with or without '+'. Any tag
+        of the user counts, not only the tasks in the config; unknown names
+        are left out.
+        """
+        names = set(t.replace("+", "") for t in tags)
+        return [tag['id'] for tag in self.user['tags'] if tag['name'] in names]
+
+    def get_todo_index(self):
+        """Get the query index over the active todos, building it if needed."""
+        if getattr(self, 'todo_index', None) is None:
+            self.todo_index = TodoIndex(self.user['todos'])
+        return self.todo_index
+
+    def get_archived_todos(self):
+        """
+        Get the completed todos from the cold archive.
+
+        They are kept out of user['todos'] so that everyday commands only
+        touch active todos, and are only loaded when asked for.
+        """
+        if getattr(self, 'archived_todos', None) is None:
+            if getattr(self, 'archive', None) is None:
+                self.archive = load_archive(self.profile)
+            self.archived_todos = [Todo(todo, hcli=self)
+                                   for todo in self.archive]
+        return self.archived_todos
+
+    def _add_tag_dicts(self, tag_dict, color_names):
+        """
+        Add the tag dictionaries to the user object from plain mappings of
+        tag ID to name and of tag name or ID to color name.
+        """
+        self.user['tag_dict'] = defaultdict(lambda: "+missingtag", tag_dict)
+        self.user['reverse_tag_dict'] = defaultdict(
+            unicode, [(name, tag_id) for tag_id, name in tag_dict.items()])
+        self.user['color_dict'] = defaultdict(
+            lambda: lambda x: x,
+            [(key, getattr(colors, name))
+             for key, name in color_names.items()])
+        self.user['color_names'] = color_names
+
+    def _snapshot_config_matches(self):
+        """Return True if the snapshot was built from the current config."""
+        snapshot = self.snapshot
+        return bool(snapshot and
+                    snapshot['config_filename'] == self.config_filename and
+                    snapshot['config_mtime'] and
+                    snapshot['config_mtime'] ==
+                    get_config_mtime(self.config_filename))
+
+    def _snapshot_matches(self, user_hash=None, cache_stat=None):
+        """
+        Return True if the derived-state snapshot was built from this config
+        and from the raw user with the given hash or cache file stat.
+        """
+        if not self._snapshot_config_matches():
+            return False
+        snapshot = self.snapshot
+        if user_hash:
+            return snapshot['user_hash'] == user_hash
+        if cache_stat:
+            return snapshot['cache_stat'] == cache_stat
+        return False
+
+    def _restore_snapshot(self):
+        """Rebuild the user object from the derived-state snapshot."""
+        snapshot = self.snapshot
+        self.user = dict(snapshot['user'])
+        self.user['todos'] = [Todo.restore(store, derived, self)
+                              for store, derived in snapshot['todos']]
+        self.user['order'] = snapshot['order']
+        self.todo_index = snapshot.get('todo_index')
+        self.archive_hash = snapshot.get('archive_hash')
+        self._add_tag_dicts(snapshot['tag_dict'], snapshot['color_names'])
+
+    def _save_snapshot(self, user_hash):
+        """
+        Save the config, tag maps, derived todo keys and todo ordering so the
+        next start can skip rebuilding them if nothing has changed.
+        """
+        active = [t for t in self.user['todos']
+                  if 'completed' in t.keys() and not t['completed']]
+        try:
+            order = [todo['id'] for todo in self.sort_nicely(active)]
+        except MultipleTasksException:
+            order = []
+        self.user['order'] = order
+
+        derived_keys = ['todos', 'tag_dict', 'reverse_tag_dict',
+                        'color_dict', 'color_names', 'order', 'cached']
+        self.snapshot = {
+            'config_filename': self.config_filename,
+            'config_mtime': get_config_mtime(self.config_filename),
+            'config': self.config,
+            'user_hash': user_hash,
+            'cache_stat': get_user_cache_stat(self.profile),
+            'user': dict((key, value) for key, value in self.user.items()
+                         if key not in derived_keys),
+            'todos': [(todo.store, todo.derived)
+                      for todo in self.user['todos']],
+            'tag_dict': dict(self.user['tag_dict']),
+            'color_names': self.user['color_names'],
+            'order': order,
+            'todo_index': self.get_todo_index(),
+            'archive_hash': self.archive_hash,
+        }
+        save_snapshot(self.snapshot, self.profile)
+
     def get_todo_str(self,
                      todo,
                      date=False,
@@ -274,8 +658,11 @@ class HabitCLI(object):
 
         return todo_str
 
-    def _print_change(self, response):
-        """Print the stat change expressed in the response."""
+    def _print_change(self, response, drops=None):
+        """
+        Print the stat change expressed in the response. 'drops' lists the
+        drops to report, by default the one in the response.
+        """
         old_exp = self.user['stats']['exp']
         old_hp = self.user['stats']['hp']
         old_gp = self.user['stats']['gp']
@@ -295,29 +682,127 @@ class HabitCLI(object):
             fragments.append("%d XP!" % (new_exp - old_exp))
         if new_gp > old_gp:
             fragments.append("%0.1f GP!" % (new_gp - old_gp))
-        if 'drop' in response['_tmp'].keys():
-            drop_key = response['_tmp']['drop']['key']
-            drop_type = response['_tmp']['drop']['type']
-            fragments.append("%s %s dropped!" % (drop_key, drop_type))
+        if drops is None:
+            drops = get_drops([response])
+        for drop in drops:
+            fragments.append("%s %s dropped!" % (drop['key'], drop['type']))
         print "\n".join(fragments)
 
+    def _select_tasks(self, tasks, terms):
+        """
+        Select tasks with '+tag' terms, which take every task with the tag,
+        and with comma-separated names, each fuzzy matched to one task.
+        """
+        selected = []
+        tag_terms = [term for term in terms if term.startswith('+')]
+        if tag_terms:
+            tag_ids = set(self.get_tag_ids(tag_terms))
+            selected.extend(task for task in tasks
+                            if tag_ids & set(tag_id for tag_id, applied
+                                             in task.get('tags', {}).items()
+                                             if applied))
+
+        names = " ".join(term for term in terms if not term.startswith('+'))
+        for name in [name.strip() for name in names.split(',')]:
+            match = process.extractOne(name, tasks,
+                                       processor=lambda x: x['text']) \
+                if name and tasks else None
+            if match and match[0] not in selected:
+                selected.append(match[0])
+        return selected
+
+    def _score_tasks(self, tasks, direction):
+        """
+        Score the tasks concurrently, then print one summary of the stat
+        changes and drops, and any failures. Returns the scored tasks.
+        """
+        async_api = self.get_async_api()
+        responses = []
+        results = [async_api.perform_task(task['id'], direction,
+                                          callback=responses.append)
+                   for task in tasks]
+        scored = []
+        for task, (_, err) in zip(tasks, wait_all(results)):
+            if err:
+                print "Could not score '%s': %s" % (task['text'], err)
+            else:
+                scored.append(task)
+        if responses:
+            # Responses arrive in any order, so none of them is sure to
+            # hold the stats after every score; fetch those once instead
+            try:
+                stats = self.api.user(fields=['stats']).get('stats')
+            except (ConnectionError, ValueError):
+                stats = None
+            self._print_change(stats or responses[-1], get_drops(responses))
+            if stats:
+                self.user['stats'] = stats
+        return scored
+
+    def _confirm_and_score(self, tasks, direction):
+        """
+        List the selected tasks and score them once confirmed. Returns the
+        scored tasks.
+        """
+        if not tasks:
+            print "No match found."
+            return []
+        for task in tasks:
+            print task['text']
+        if not confirm(resp=True):
+            return []
+        return self._score_tasks(tasks, direction)
+
+    @named('score')
+    def score_habits(self, down=False, *habits):
+        """
+        Score habits up, or down with --down. Habits are selected by '+tag'
+        or by comma-separated names, e.g. 'habit score water, stretch'.
+        """
+        selected = self._select_tasks(self.user.get('habits', []), habits)
+        direction = self.api.DIRECTION_DOWN if down else self.api.DIRECTION_UP
+        self._confirm_and_score(selected, direction)
+
+    @named('daily')
+    def complete_dailies(self, undo=False, *dailies):
+        """
+        Check off dailies, or uncheck them with --undo. Dailies are selected
+        by '+tag' or by comma-separated names.
+        """
+        dailies_left = [daily for daily in self.user.get('dailys', [])
+                        if bool(daily.get('completed')) == undo]
+        selected = self._select_tasks(dailies_left, dailies)
+        direction = self.api.DIRECTION_DOWN if undo else self.api.DIRECTION_UP
+        for daily in self._confirm_and_score(selected, direction):
+            daily['completed'] = not undo
+
     @named('ls')
-    def list_todos(self, raw=False, completed=False, list_tasks=False, *tags):
+    def list_todos(self, raw=False, completed=False, list_tasks=False, *query):
         """
-        Print the incomplete tasks.
+        Print the incomplete tasks, optionally filtered by a query such as
+        'work due<friday text~deploy'. See habitcli.query for the terms.
         """
+        try:
+            compiled = compile_query(query,
+                                     lambda name: self.get_tag_ids([name]))
+        except (ValueError, DateParseException) as err:
+            print err
+            sys.exit(1)
+
         if self.user['cached']:
             print 'Cached'
 
-        todos = [t for t in self.user['todos']
+        todos = self.user['todos']
+        index = self.get_todo_index()
+        if completed:
+            # The index only covers the active todos
+            todos = todos + self.get_archived_todos()
+            index = None
+        todos = run_query(compiled, todos, index)
+        todos = [t for t in todos
                  if 'completed' in t.keys()
                  and (completed or not t['completed'])]
 
-        if tags:
-            tag_ids = [self.user['reverse_tag_dict'][t.replace("+", "")]
-                       for t in tags]
-            todos = [todo for todo in todos if todo.has_tags(tag_ids)]
-
         # Print the raw json data
         if raw:
             for todo in todos:
@@ -354,9 +839,60 @@ class HabitCLI(object):
                 for todo in tagtodos:
                     print "\t", color(self.get_todo_str(todo))
 
+    def get_search_results(self, query, limit=10):
+        """
+        Rank the active and archived todos against a search query. The
+        saved index answers on its own; the archive is only loaded to build
+        an index that is missing.
+        """
+        if self.is_replaying():
+            # Keep the stored index of the real todos out of a replay
+            index = SearchIndex()
+            index.sync(self.user['todos'] + self.get_archived_todos())
+            return index.search(query, limit)
+        index = get_search_index(self.profile)
+        if not index.docs:
+            index = update_search_index(
+                self.user['todos'] + self.get_archived_todos(), self.profile)
+        return index.search(query, limit)
+
+    @named('search')
+    def search_todos(self, limit=10, *query):
+        """
+        Search the text, notes and checklists of all todos, including the
+        completed ones, and print the best matches first.
+        """
+        results = self.get_search_results(" ".join(query), int(limit))
+        if not results:
+            print "No matches"
+        for score, _, text, completed in results:
+            line = "%5.2f  %s" % (score, text)
+            print colors.faint(line) if completed else line
+
     @named('stats')
-    def print_stat_bar(self):
-        """Print the HP, MP, and XP bars, with some nice coloring."""
+    def print_stat_bar(self, watch=False, interval=60.0, output="",
+                       history=""):
+        """
+        Print the HP, MP, and XP bars, with some nice coloring.
+
+        With --watch, keep polling every 'interval' seconds and redraw the
+        bars in place when they change; with --output, also write them to
+        the given file for status bar tools to read. With --history, e.g.
+        '30d', show how the stats changed over that period instead.
+        """
+        if history:
+            self._print_stats_history(history)
+            return
+        if watch:
+            self._watch_stats(float(interval), output)
+            return
+        lines = self._stat_bar_lines()
+        print "\n".join(lines)
+        if output:
+            write_atomic(output, "\n".join(lines) + "\n")
+
+    def _stat_bar_lines(self):
+        """Return the lines of the HP, MP, and XP bars."""
         current_hp = int(self.user['stats']['hp'])
         max_hp = int(self.user['stats']['maxHealth'])
         current_mp = int(self.user['stats']['mp'])
@@ -381,11 +917,163 @@ class HabitCLI(object):
         mp_bar = ("="*int(mp_percent*width)).ljust(width)
         xp_bar = ("="*int(xp_percent*width)).ljust(width)
 
-        print "HP: " + hp_color("[" + hp_bar + "]")
-        print "MP: " + colors.blue("[" + mp_bar + "]")
-        print "XP: [" + xp_bar + "]"
+        lines = ["HP: " + hp_color("[" + hp_bar + "]"),
+                 "MP: " + colors.blue("[" + mp_bar + "]"),
+                 "XP: [" + xp_bar + "]"]
         if self.user['cached']:
-            print "(Cached)"
+            lines.append("(Cached)")
+        return lines
+
+    def _print_stats_history(self, duration):
+        """Print sparklines of the recorded stats over the given duration."""
+        width = 60
+        start = time.time() - parse_duration(duration)
+        samples = StatsHistory(profile=self.profile).query(
+            start, max_points=width * 10)
+        if not samples:
+            print "No stats recorded in the last %s" % duration
+            return
+
+        print "%s to now, %d samples" % \
+            (pretty.date(datetime.datetime.fromtimestamp(samples[0][0])),
+             len(samples))
+        for name, index in [('HP', 1), ('MP', 2), ('XP', 3), ('GP', 4)]:
+            values = [sample[index] for sample in samples]
+            print "%s: [%s] %.0f -> %.0f" % \
+                (name, sparkline(values, width), values[0], values[-1])
+        if samples[-1][5] > samples[0][5]:
+            print "Level %d -> %d" % (samples[0][5], samples[-1][5])
+
+    def _watch_stats(self, interval, output):
+        """
+        Redraw the stat bars whenever they change.
+
+        Polls with a conditional request, so an unchanged user costs a 304
+        rather than the full document, and backs off while the server is
+        unreachable.
+        """
+        async_api = self.get_async_api()
+        etag = None
+        drawn = []
+        failures = 0
+        try:
+            while True:
+                lines = self._stat_bar_lines()
+                if lines != drawn:
+                    if sys.stdout.isatty():
+                        drawn = redraw(drawn, lines)
+                    else:
+                        print "\n".join(lines)
+                        sys.stdout.flush()
+                        drawn = lines
+                    if output:
+                        write_atomic(output, "\n".join(lines) + "\n")
+
+                time.sleep(min(interval * 2 ** failures, interval * 10))
+                try:
+                    raw_user, etag = async_api.user_if_changed(
+                        etag, fields=['stats'])
+                    failures = 0
+                except (ConnectionError, HabitAPIError):
+                    self.user['cached'] = True
+                    failures += 1
+                    continue
+                if raw_user and 'stats' in raw_user:
+                    self.user['stats'] = raw_user['stats']
+                    StatsHistory(profile=self.profile).append(
+                        raw_user['stats'])
+                self.user['cached'] = False
+        except KeyboardInterrupt:
+            pass
+
+    @named('agenda')
+    @arg('--from', dest='start')
+    @arg('--to', dest='end')
+    def print_agenda(self, start="today", end="+14d", counts=False):
+        """
+        Print the todos planned or due on each day from --from to --to,
+        inclusive. With --counts, print only how many there are each day.
+        """
+        try:
+            first_day = parse_day(start)
+            last_day = parse_day(end, first_day)
+        except (ValueError, DateParseException) as err:
+            print err
+            sys.exit(1)
+        num_days = max((last_day - first_day).days + 1, 0)
+        boundaries = day_boundaries(first_day, num_days)
+        index = self.get_todo_index()
+        days = [first_day + datetime.timedelta(days=offset)
+                for offset in range(num_days)]
+
+        if counts:
+            for day, planned, due in zip(days,
+                                         index.date_counts('plan', boundaries),
+                                         index.date_counts('due', boundaries)):
+                print "%s  %3d planned  %3d due  %s" % \
+                    (day.strftime("%a %d %b"), planned, due, "#" * planned)
+            return
+
+        todos = dict((todo['id'], todo) for todo in self.user['todos'])
+        planned = bucket_by_day(
+            index.date_entries('plan', boundaries[0], boundaries[-1]),
+            boundaries)
+        due = bucket_by_day(
+            index.date_entries('due', boundaries[0], boundaries[-1]),
+            boundaries)
+        for day, planned_ids, due_ids in zip(days, planned, due):
+            if not planned_ids and not due_ids:
+                continue
+            print "%s (%s):" % (day.strftime("%a %d %b"), pretty.date(day))
+            for todo_id in planned_ids:
+                todo = todos[todo_id]
+                color = self.user['color_dict'][todo.get_primary_tag()]
+                print "\t", color(self.get_todo_str(todo))
+            for todo_id in due_ids:
+                todo = todos[todo_id]
+                color = self.user['color_dict'][todo.get_primary_tag()]
+                print "\t", color(self.get_todo_str(todo)), "(due)"
+
+    @named('remind')
+    def remind(self, command="", lead="0m", sync_interval=900.0):
+        """
+        Stay in the foreground and remind of plan and due dates as they come,
+        'lead' (e.g. '15m') ahead. --command runs a shell command for each
+        reminder with HABIT_REMINDER, HABIT_TODO_ID and HABIT_TODO_TEXT set;
+        otherwise the reminder is printed. The todos are fetched again every
+        --sync-interval seconds, only if they have changed.
+        """
+        sync_interval = float(sync_interval)
+        queue = ReminderQueue(parse_duration(lead))
+        queue.sync(self.user['todos'], time.time())
+        async_api = self.get_async_api()
+        etag = None
+        next_sync = time.time() + sync_interval if sync_interval else None
+
+        try:
+            while True:
+                now = time.time()
+                for reminder in queue.pop_due(now):
+                    notify(reminder, command)
+
+                if next_sync and now >= next_sync:
+                    try:
+                        user, etag = async_api.user_if_changed(
+                            etag, fields=['todos'])
+                    except (ConnectionError, HabitAPIError):
+                        user = None
+                    if user is not None:
+                        queue.sync([Todo(todo, hcli=self)
+                                    for todo in user['todos']], now)
+                    next_sync = now + sync_interval
+
+                # Sleep until the next reminder or sync
+                wake_times = [wake for wake in [queue.next_time(), next_sync]
+                              if wake]
+                time.sleep(max(0.0, min(wake_times) - time.time())
+                           if wake_times else 3600.0)
+        except KeyboardInterrupt:
+            pass
 
     @named('add')
     def add_todo(self, todo, due_date="", plan_date="", *tags):
@@ -409,6 +1097,68 @@ class HabitCLI(object):
 
         new_todo.create()
 
+    @named('import')
+    def import_todos(self, filename, workers=4, rate=None, restart=False):
+        """
+        Create todos in bulk from an NDJSON or CSV file.
+
+        Progress is checkpointed next to the input file, so an interrupted
+        import can be rerun and will skip the todos already created.
+        """
+        checkpoint_filename = filename + ".checkpoint"
+        if restart and os.path.exists(checkpoint_filename):
+            os.remove(checkpoint_filename)
+
+        importer = TodoImporter(self,
+                                workers=int(workers),
+                                rate=float(rate) if rate else None,
+                                checkpoint_filename=checkpoint_filename)
+        summary = importer.run(read_records(filename))
+        print format_summary(summary)
+
+    @named('dedupe')
+    def dedupe_todos(self, threshold=85, merge=False):
+        """
+        List groups of near-duplicate incomplete todos. With --merge, move
+        the checklist items of each group into the todo kept and delete the
+        others.
+        """
+        todos = list(self.user['todos'])
+        tags = []
+        for todo in todos:
+            try:
+                tags.append(todo.get_primary_tag())
+            except MultipleTasksException:
+                tags.append(None)
+
+        clusters = find_duplicates(todos, tags, int(threshold))
+        if not clusters:
+            print "No duplicates found."
+            return
+        for cluster in clusters:
+            print "Keep: %s" % todos[cluster[0][0]]['text']
+            for index, score in cluster[1:]:
+                print "\t%3d%%  %s" % (score, todos[index]['text'])
+        if not merge:
+            return
+
+        duplicates = [[todos[index] for index, _ in cluster[1:]]
+                      for cluster in clusters]
+        print "Merge and delete %d duplicates?" % sum(map(len, duplicates))
+        if not confirm(resp=True):
+            return
+        with self.batch():
+            for cluster, cluster_duplicates in zip(clusters, duplicates):
+                keep = todos[cluster[0][0]]
+                if merge_checklists(keep, cluster_duplicates):
+                    keep.update_db()
+
+        losers = [todo for cluster in duplicates for todo in cluster]
+        results = [todo.delete_async() for todo in losers]
+        for todo, (_, err) in zip(losers, wait_all(results)):
+            if err:
+                print "Could not delete '%s': %s" % (todo['text'], err)
+
     @named('detail')
     def print_detailed_string(self, todo_string):
         """Print a detailed description of the described todo."""
@@ -487,32 +1237,64 @@ class HabitCLI(object):
             selected_todo.delete()
 
     @named('do')
-    def complete_todo(self, *todos):
-        """Complete a task selected by natural language with a confirmation."""
+    def complete_todo(self, multi=False, *todos):
+        """
+        Complete a task selected by natural language with a confirmation.
+        With --multi, complete several comma-separated tasks or checklist
+        items at once; the items of one todo are sent in a single update.
+        """
         todo_string = " ".join(todos)
+        if multi:
+            todo_strings = [string.strip()
+                            for string in todo_string.split(',')
+                            if string.strip()]
+        else:
+            todo_strings = [todo_string]
+
+        selected_todos = []
+        for string in todo_strings:
+            selected_todo = self.match_todo_by_string(string)
+            if selected_todo not in selected_todos:
+                selected_todos.append(selected_todo)
+                print selected_todo['todo']['text']
+        if not confirm(resp=True):
+            return
 
-        selected_todo = self.match_todo_by_string(todo_string)
-
-        print selected_todo['todo']['text']
-        if confirm(resp=True):
-            # If it has a parent, it is a checklist item
-            parent = selected_todo['parent']
-            if parent:
-
-                # Mark the checklist item as complete and repost
-                check_index = selected_todo['check_index']
-                parent['checklist'][check_index]['completed'] = True
-                parent.update_db()
-                # Print the remaining sections of the task
-                print self.get_todo_str(parent, completed_faint=True)
-
-            # Otherwise it is a normal to-do
-            else:
-                selected_todo['todo'].complete()
-                self._print_change(selected_todo['todo'])
+        # Checklist items are marked complete on their parents, and each
+        # parent is reposted once
+        parents = []
+        with self.batch():
+            for selected_todo in selected_todos:
+                parent = selected_todo['parent']
+                if parent:
+                    check_index = selected_todo['check_index']
+                    parent['checklist'][check_index]['completed'] = True
+                    parent.update_db()
+                    if parent not in parents:
+                        parents.append(parent)
+        # Print the remaining sections of each task
+        for parent in parents:
+            print self.get_todo_str(parent, completed_faint=True)
+
+        # The rest are normal to-dos
+        completed = [selected_todo['todo'] for selected_todo in selected_todos
+                     if not selected_todo['parent']]
+        if len(completed) == 1:
+            completed[0].complete()
+            self._print_change(completed[0])
+        elif completed:
+            for todo in self._score_tasks(completed, self.api.DIRECTION_UP):
+                todo['completed'] = True
 
     def sort_nicely(self, todos):
         """Sort the todos by date and task."""
+        # Reuse the ordering saved in the snapshot when it covers every todo
+        position = dict((todo_id, index) for index, todo_id
+                        in enumerate(self.user.get('order', [])))
+        if all(todo.get('id') in position for todo in todos):
+            todos.sort(key=lambda todo: position[todo['id']])
+            return todos
+
         def sort_primary_tag(todo):
             """
             Return the list index in self.config['tasks'] of the primary tag.
@@ -556,38 +1338,164 @@ class HabitCLI(object):
         return todos
 
     @named('gui')
-    def launch_graphical_window(self, *tags):
+    def launch_graphical_window(self, refresh=0, *tags):
         """
         Launch a graphical window to edit the tasks, optionally limited to
-        those defined by the given tags.
+        those defined by the given tags and refreshed every 'refresh'
+        seconds.
         """
-        todos = [t for t in self.user['todos']
-                 if 'completed' in t.keys() and not t['completed']]
-        if tags:
-            tag_ids = [self.user['reverse_tag_dict'][t.replace("+", "")]
-                       for t in tags]
-            todos = [todo for todo in todos if todo.has_tags(tag_ids)]
+        tag_ids = self.get_tag_ids(tags)
+
+        def todo_filter(todo):
+            """Select the incomplete todos with the given tags."""
+            return 'completed' in todo.keys() and not todo['completed'] \
+                and (not tag_ids or todo.has_tags(tag_ids))
 
+        todos = [t for t in self.user['todos'] if todo_filter(t)]
         todos = self.sort_nicely(todos)
-        habitcli.gui.make_gui(self, todos)
+        habitcli.gui.make_gui(self, todos, todo_filter, float(refresh))
+
+
+class MultiHabitCLI(HabitCLI):
+    """
+    A merged, read-only view over every profile in the config file.
+
+    Each profile is loaded by its own HabitCLI, all of them concurrently, so
+    startup takes about as long as the slowest account rather than the sum.
+    """
+    def __init__(self, config_filename=None):
+        """Load every profile and merge their todos and tags."""
+        # pylint: disable=super-init-not-called
+        self.config_filename = config_filename or \
+            get_default_config_filename()
+        self.profile = 'all'
+        self.members = self._load_members(list_profiles(self.config_filename))
+
+        self.config = {'tasks': [], 'taskcolors': {}}
+        for member in self.members:
+            for task in member.config['tasks']:
+                if task not in self.config['tasks']:
+                    self.config['tasks'].append(task)
+            self.config['taskcolors'].update(member.config['taskcolors'])
+        self.user = self._merge_users()
+
+    def _load_members(self, profiles):
+        """Construct a HabitCLI per profile, each in its own thread."""
+        results = {}
+
+        def load(profile):
+            """Load one profile, keeping any error for the main thread."""
+            try:
+                results[profile] = HabitCLI(self.config_filename, profile,
+                                            read_only=True)
+            except BaseException as err:  # pylint: disable=broad-except
+                results[profile] = err
+
+        threads = [threading.Thread(target=load, args=(profile,))
+                   for profile in profiles]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        for profile in profiles:
+            if isinstance(results[profile], BaseException):
+                raise results[profile]
+        return [results[profile] for profile in profiles]
+
+    def _merge_users(self):
+        """Build a user object combining the todos and tags of all members."""
+        user = {'todos': [],
+                'tag_dict': defaultdict(lambda: "+missingtag"),
+                'reverse_tag_dict': defaultdict(unicode),
+                'color_dict': defaultdict(lambda: lambda x: x),
+                'cached': False}
+        for member in self.members:
+            # Each todo keeps its own member, so its tags resolve correctly
+            user['todos'].extend(member.user['todos'])
+            user['tag_dict'].update(member.user['tag_dict'])
+            for name, tag_id in member.user['reverse_tag_dict'].items():
+                user['reverse_tag_dict'].setdefault(name, tag_id)
+            user['color_dict'].update(member.user['color_dict'])
+            user['cached'] = user['cached'] or member.user['cached']
+        return user
+
+    def get_user(self, refresh=False):
+        """Get the merged user, refreshing every member if asked."""
+        if refresh:
+            self.members = self._load_members(
+                [member.profile for member in self.members])
+            self.user = self._merge_users()
+        return self.user
+
+    def get_archived_todos(self):
+        """Get the archived todos of every member."""
+        return [todo for member in self.members
+                for todo in member.get_archived_todos()]
+
+    def get_tag_ids(self, tags):
+        """Return the IDs of the given tag names in every member."""
+        tag_ids = []
+        for member in self.members:
+            tag_ids.extend(member.get_tag_ids(tags))
+        return tag_ids
+
+    def get_search_results(self, query, limit=10):
+        """Rank the todos of every member against a search query."""
+        results = []
+        for member in self.members:
+            results.extend(member.get_search_results(query, limit))
+        return sorted(results, key=lambda result: -result[0])[:limit]
+
+    @named('stats')
+    def print_stat_bar(self, history=""):
+        """Print the stat bars of every profile."""
+        for member in self.members:
+            print "%s:" % (member.profile if member.profile else "default")
+            member.print_stat_bar(history=history)
+
+
+# Commands that may show the cached user rather than wait on a slow network
+READ_ONLY_COMMANDS = ['ls', 'stats', 'search', 'agenda', 'detail']
 
 
 def main():
     """Main entry point to the command line interface."""
 
-    hcli = HabitCLI()
+    # --profile selects the HabitCLI, so it is parsed before the commands
+    profile_parser = argparse.ArgumentParser(add_help=False)
+    profile_parser.add_argument('--profile')
+    options, argv = profile_parser.parse_known_args()
+    command = next((arg for arg in argv if not arg.startswith('-')), None)
 
     argh_parser = argh.ArghParser()
-    argh_parser.add_commands([hcli.list_todos,
-                              hcli.print_stat_bar,
-                              hcli.add_todo,
-                              hcli.add_checklist_item,
-                              hcli.delete_todo,
-                              hcli.complete_todo,
-                              hcli.print_detailed_string,
-                              hcli.update_todo_plan_date,
-                              hcli.launch_graphical_window])
-    argh_parser.dispatch()
+
+    if options.profile == 'all':
+        hcli = MultiHabitCLI()
+        argh_parser.add_commands([hcli.list_todos,
+                                  hcli.print_stat_bar,
+                                  hcli.search_todos,
+                                  hcli.print_agenda])
+    else:
+        hcli = HabitCLI(profile=options.profile,
+                        read_only=command in READ_ONLY_COMMANDS)
+        argh_parser.add_commands([hcli.list_todos,
+                                  hcli.print_stat_bar,
+                                  hcli.search_todos,
+                                  hcli.print_agenda,
+                                  hcli.add_todo,
+                                  hcli.import_todos,
+                                  hcli.add_checklist_item,
+                                  hcli.delete_todo,
+                                  hcli.complete_todo,
+                                  hcli.score_habits,
+                                  hcli.complete_dailies,
+                                  hcli.dedupe_todos,
+                                  hcli.remind,
+                                  hcli.print_detailed_string,
+                                  hcli.update_todo_plan_date,
+                                  hcli.launch_graphical_window])
+    argh_parser.dispatch(argv=argv)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,46 @@
+"""
+Day-by-day views of planned and due todos.
+
+A window of days is split at local midnights, and each day's todos, or just
+their number, are read from the sorted date arrays of the TodoIndex by
+bisection, so the cost follows the size of the window rather than the
+number of todos.
+"""
+
+import datetime
+import time
+
+from habitcli.history import parse_duration
+from habitcli.utils import parse_datetime
+
+
+def parse_day(day_string, first_day=None):
+    """
+    Parse a day of a window: a natural language date such as 'today' or
+    'friday', or, given the first day, a duration after it such as '+14d'.
+    """
+    if day_string.startswith('+') and first_day is not None:
+        return first_day + datetime.timedelta(
+            seconds=parse_duration(day_string[1:]))
+    return parse_datetime(day_string).date()
+
+
+def day_boundaries(first_day, num_days):
+    """Return the local midnights starting each day, and ending the last."""
+    return [time.mktime((first_day +
+                         datetime.timedelta(days=offset)).timetuple())
+            for offset in range(num_days + 1)]
+
+
+def bucket_by_day(entries, boundaries):
+    """
+    Split (timestamp, ID) entries, sorted and within the boundaries, into a
+    list of IDs per day.
+    """
+    buckets = [[] for _ in boundaries[1:]]
+    day = 0
+    for timestamp, todo_id in entries:
+        while timestamp >= boundaries[day + 1]:
+            day += 1
+        buckets[day].append(todo_id)
+    return buckets
@@ -0,0 +1,165 @@
+"""
+A concurrent HabitRPG API client.
+
+Mirrors the HabitAPI methods used by habitcli, but each call is run on a
+bounded worker pool over a pooled keep-alive session and returns an
+AsyncResult immediately, so many task updates can be in flight at once.
+"""
+
+import json
+from multiprocessing.pool import ThreadPool
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from habitcli.exceptions import HabitAPIError
+from habitcli.jsonstream import project
+from habitcli.ratelimit import AdaptiveLimiter, send_with_retries
+from habitcli.ratelimit import DEFAULT_TIMEOUT, STREAM_CHUNK_SIZE
+
+
+DEFAULT_BASE_URL = "https://habitrpg.com/"
+
+
+def check_response(response):
+    """Raise HabitAPIError for a response with an error status."""
+    if 200 <= response.status_code < 300:
+        return
+    try:
+        error = response.json().get('err', response.reason)
+    except (ValueError, AttributeError):
+        error = response.reason
+    raise HabitAPIError(response.status_code, error)
+
+
+class AsyncHabitAPI(object):
+    """Concurrent counterpart to pyhabit's HabitAPI."""
+    DIRECTION_UP = "up"
+    DIRECTION_DOWN = "down"
+
+    def __init__(self, user_id, api_key, base_url=None, concurrency=8,
+                 limiter=None, max_retries=2, timeout=DEFAULT_TIMEOUT):
+        self.user_id = user_id
+        self.api_key = api_key
+        self.base_url = (base_url or DEFAULT_BASE_URL).rstrip('/') + '/'
+        self.limiter = limiter if limiter else AdaptiveLimiter()
+        self.max_retries = max_retries
+        self.timeout = timeout
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=concurrency)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.session.headers.update({'x-api-user': user_id,
+                                     'x-api-key': api_key})
+        self.pool = ThreadPool(concurrency)
+
+    @classmethod
+    def from_api(cls, api, concurrency=8):
+        """
+        Build a client sharing the credentials and limiter of 'api'. Raises
+        ValueError if 'api' replays a cassette, which this client cannot.
+        """
+        if getattr(api, 'replaying', False):
+            raise ValueError("Concurrent requests cannot be replayed from a "
+                             "cassette")
+        return cls(api.user_id,
+                   api.api_key,
+                   base_url=getattr(api, 'base_url', None),
+                   concurrency=concurrency,
+                   limiter=getattr(api, 'limiter', None),
+                   max_retries=getattr(api, 'max_retries', 2),
+                   timeout=getattr(api, 'timeout', DEFAULT_TIMEOUT))
+
+    def request(self, method, path, data=None, **kwargs):
+        """
+        Synchronously send one request and return the decoded JSON. Raises
+        HabitAPIError if the server rejects the request.
+        """
+        url = self.base_url + "api/v2/" + path
+        if data is not None:
+            kwargs['data'] = json.dumps(data)
+            kwargs['headers'] = {'Content-Type': 'application/json'}
+        kwargs.setdefault('timeout', self.timeout)
+        send = lambda: self.session.request(method, url, **kwargs)
+        response = send_with_retries(self.limiter, send, method,
+                                     self.max_retries)
+        check_response(response)
+        body = response.json() if response.content else {}
+        if isinstance(body, dict) and 'err' in body:
+            raise HabitAPIError(response.status_code, body['err'])
+        return body
+
+    def user_if_changed(self, etag=None, fields=None):
+        """
+        Synchronously fetch the user unless it still matches 'etag'.
+
+        Only the top-level 'fields' are decoded, if given. Returns the user
+        (None if unchanged) and the ETag to send next time.
+        """
+        url = self.base_url + "api/v2/user"
+        headers = {'If-None-Match': etag} if etag else {}
+        send = lambda: self.session.get(url, headers=headers, stream=True,
+                                        timeout=self.timeout)
+        response = send_with_retries(self.limiter, send, 'get',
+                                     self.max_retries)
+        if response.status_code == 304:
+            response.close()
+            return None, etag
+        check_response(response)
+        if fields:
+            user = project(response.iter_content(STREAM_CHUNK_SIZE), fields)
+        else:
+            user = response.json()
+        return user, response.headers.get('ETag')
+
+    def _submit(self, method, path, data=None, callback=None):
+        """Queue a request on the worker pool and return an AsyncResult."""
+        return self.pool.apply_async(self.request, (method, path, data),
+                                     callback=callback)
+
+    def user(self, callback=None):
+        """Fetch the full user document."""
+        return self._submit('get', 'user', callback=callback)
+
+    def update_task(self, task_id, task, callback=None):
+        """Replace a task with the given values."""
+        return self._submit('put', 'user/tasks/%s' % task_id, task,
+                            callback=callback)
+
+    def perform_task(self, task_id, direction, callback=None):
+        """Score a task up or down."""
+        return self._submit('post', 'user/tasks/%s/%s' % (task_id, direction),
+                            callback=callback)
+
+    def create_todo(self, todo, callback=None):
+        """Create a new todo."""
+        todo = dict(todo, type='todo')
+        return self._submit('post', 'user/tasks', todo, callback=callback)
+
+    def delete_task(self, task_id, callback=None):
+        """Delete a task."""
+        return self._submit('delete', 'user/tasks/%s' % task_id,
+                            callback=callback)
+
+    def close(self):
+        """Wait for outstanding requests and stop the workers."""
+        self.pool.close()
+        self.pool.join()
+        self.session.close()
+
+
+def wait_all(results, timeout=None):
+    """
+    Wait for a list of AsyncResults.
+
+    Returns a list of (value, error) pairs in the same order, where exactly
+    one of the two is None.
+    """
+    outcomes = []
+    for result in results:
+        try:
+            outcomes.append((result.get(timeout), None))
+        except Exception as err:  # pylint: disable=broad-except
+            outcomes.append((None, err))
+    return outcomes
@@ -0,0 +1,190 @@
+"""
+Recording and replay of HabitRPG API traffic.
+
+A cassette is a gzipped file of JSON lines, one per request: the method,
+path and request body, and the status, headers, body and latency of the
+response. Bodies are anonymized as they are recorded. Words in free text
+are replaced by pseudo-words of the same length, so payload shapes such as
+text lengths, checklist sizes and duplicate texts are kept. Serialized plan
+dates in notes are also kept, and so are the tag names in the config.
+Credentials and other private parts of the user are dropped.
+
+ReplayHabitAPI serves a cassette in place of the network, either with the
+recorded latencies or at full speed. A replayed user is not written to the
+cache, and the concurrent client, which would reach the network, refuses
+to run during a replay.
+"""
+
+import gzip
+import hashlib
+import json
+import os
+import re
+import string
+import time
+
+from requests import ConnectionError
+from requests.models import Response
+from requests.structures import CaseInsensitiveDict
+
+from habitcli.ratelimit import ThrottledHabitAPI
+from habitcli.utils import deserialize_date
+
+
+# Keys whose string values are free text, and anonymized
+TEXT_KEYS = set(['text', 'notes', 'name', 'blurb', 'email', 'username',
+                 'imageUrl', 'message'])
+
+# Keys dropped altogether, wherever they appear
+PRIVATE_KEYS = set(['auth', 'apiToken', 'inbox', 'webhooks', 'pushDevices',
+                    'invitations', 'newMessages'])
+
+# Response headers worth keeping
+HEADERS = ['Content-Type', 'ETag', 'Retry-After']
+
+WORD_RE = re.compile(r'\w+', re.UNICODE)
+
+
+class Anonymizer(object):
+    """Replaces words with stable pseudo-words of the same length."""
+    def __init__(self, keep=None):
+        self.keep = set(keep if keep else [])
+        # A fresh salt per recording, so pseudo-words cannot be looked up
+        self.salt = os.urandom(16)
+
+    def word(self, match):
+        """Replace one word."""
+        word = match.group()
+        digest = hashlib.sha1(self.salt + word.encode('utf-8')).digest()
+        letters = string.ascii_lowercase
+        return u"".join(letters[ord(digest[i % len(digest)]) % len(letters)]
+                        for i in range(len(word)))
+
+    def text(self, text):
+        """Anonymize free text, keeping whitespace and punctuation."""
+        if text in self.keep:
+            return text
+        return WORD_RE.sub(self.word, text)
+
+    def value(self, value, key=None):
+        """Anonymize a decoded JSON value."""
+        if isinstance(value, dict):
+            return dict((item_key, self.value(item, item_key))
+                        for item_key, item in value.items()
+                        if item_key not in PRIVATE_KEYS)
+        if isinstance(value, list):
+            return [self.value(item, key) for item in value]
+        if isinstance(value, basestring) and key in TEXT_KEYS:
+            if key == 'notes' and value and deserialize_date(value):
+                return value
+            return self.text(value)
+        return value
+
+    def body(self, body):
+        """Anonymize a JSON body given as text, or drop it if not JSON."""
+        if not body:
+            return body
+        try:
+            return json.dumps(self.value(json.loads(body)))
+        except ValueError:
+            return ""
+
+
+class CassetteRecorder(object):
+    """Appends anonymized interactions to a cassette file."""
+    def __init__(self, filename, keep=None):
+        self.filename = filename
+        self.anonymizer = Anonymizer(keep)
+
+    def record(self, method, path, data, response, elapsed):
+        """Record one request and its response."""
+        if isinstance(data, dict):
+            data = json.dumps(data)
+        interaction = {
+            'time': time.time(),
+            'method': method.lower(),
+            'path': path.strip('/'),
+            'data': self.anonymizer.body(data),
+            'status': response.status_code,
+            'headers': dict((name, response.headers[name])
+                            for name in HEADERS if name in response.headers),
+            'body': self.anonymizer.body(response.content),
+            'elapsed': elapsed,
+        }
+        # Each call adds a gzip member, which gzip reads back as one stream
+        cassette = gzip.open(self.filename, 'ab')
+        try:
+            cassette.write(json.dumps(interaction) + "\n")
+        finally:
+            cassette.close()
+
+
+def read_cassette(filename):
+    """Read the interactions of a cassette, in order."""
+    cassette = gzip.open(filename, 'rb')
+    try:
+        return [json.loads(line) for line in cassette if line.strip()]
+    finally:
+        cassette.close()
+
+
+def make_response(interaction):
+    """Build a requests Response from a recorded interaction."""
+    response = Response()
+    response.status_code = interaction['status']
+    response.headers = CaseInsensitiveDict(interaction['headers'])
+    response.encoding = 'utf-8'
+    response._content = interaction['body'].encode('utf-8')
+    response._content_consumed = True
+    return response
+
+
+class RecordingHabitAPI(ThrottledHabitAPI):
+    """A HabitAPI that records its traffic to a cassette."""
+    def __init__(self, user_id, api_key, recorder=None, **kwargs):
+        ThrottledHabitAPI.__init__(self, user_id, api_key, **kwargs)
+        self.recorder = recorder
+
+    def send(self, method, path, *args, **kwargs):
+        """Send one request and record it."""
+        start = time.time()
+        response = ThrottledHabitAPI.send(self, method, path, *args, **kwargs)
+        # Recording reads the whole body, which stays available to stream
+        self.recorder.record(method, path, kwargs.get('data'), response,
+                             time.time() - start)
+        return response
+
+
+class ReplayHabitAPI(ThrottledHabitAPI):
+    """
+    A HabitAPI that serves the responses in a cassette.
+
+    Requests are matched by method and path, in recorded order; once the
+    recorded responses to a request run out, the last one is repeated.
+    With 'speed' 1.0 each response takes its recorded time, with 2.0 half
+    of it, and with 0 none.
+    """
+    replaying = True
+
+    def __init__(self, user_id, api_key, cassette=None, speed=0.0, **kwargs):
+        ThrottledHabitAPI.__init__(self, user_id, api_key, **kwargs)
+        self.speed = float(speed)
+        self.interactions = {}
+        for interaction in read_cassette(cassette):
+            key = (interaction['method'], interaction['path'])
+            self.interactions.setdefault(key, []).append(interaction)
+
+    def send(self, method, path, *args, **kwargs):
+        """Serve the next recorded response to the request."""
+        recorded = self.interactions.get((method.lower(), path.strip('/')))
+        if not recorded:
+            raise ConnectionError("No recorded response to %s %s" %
+                                  (method, path))
+        interaction = recorded.pop(0) if len(recorded) > 1 else recorded[0]
+        if self.speed:
+            time.sleep(interaction['elapsed'] / self.speed)
+        return make_response(interaction)
+
+    def request(self, method, path, *args, **kwargs):
+        """Serve a request without throttling or retries."""
+        return self.send(method, path, *args, **kwargs)
@@ -0,0 +1,144 @@
+"""
+A feed of the changes between syncs.
+
+Each sync is diffed against the last one by todo ID, using content hashes
+so unchanged todos are skipped cheaply. Only the hashes and the fields of
+active todos are kept between syncs; archived todos rarely change, so once
+seen they are not hashed again. A sync that changed anything appends one
+JSON event per line to the change log, and the event is handed to an
+optional hook command, so other tools can follow small deltas instead of
+re-reading the whole task list.
+"""
+
+import hashlib
+import json
+import os
+import cPickle as pickle
+import subprocess
+import tempfile
+import time
+
+from habitcli.utils import get_cache_filename
+
+
+STAT_KEYS = ['hp', 'mp', 'exp', 'gp', 'lvl']
+
+EMPTY_STATE = {'hashes': {}, 'todos': {}, 'stats': {}}
+
+
+def todo_hash(todo):
+    """Hash the full content of a todo."""
+    return hashlib.sha1(json.dumps(dict(todo), sort_keys=True)).hexdigest()
+
+
+def field_changes(old, new):
+    """Return {field: [old value, new value]} for the fields that differ."""
+    return dict((key, [old.get(key), new.get(key)])
+                for key in set(old) | set(new)
+                if old.get(key) != new.get(key))
+
+
+def diff_sync(old_state, todos, stats):
+    """
+    Compare the todos and stats of a sync with the state of the last one.
+    Returns the new state and the event, which is None if nothing changed.
+    """
+    old_hashes = old_state['hashes']
+    old_todos = old_state['todos']
+    hashes = {}
+    new_todos = {}
+    event = {'added': [], 'completed': [], 'deleted': [], 'changed': []}
+    for todo in todos:
+        todo_id = todo['id']
+        archived = bool(todo.get('completed'))
+        if archived and todo_id in old_hashes and todo_id not in old_todos:
+            hashes[todo_id] = old_hashes[todo_id]
+            continue
+        todo = dict(todo)
+        hashes[todo_id] = todo_hash(todo)
+        if not archived:
+            new_todos[todo_id] = todo
+        if todo_id not in old_hashes:
+            event['added'].append({'id': todo_id, 'text': todo['text']})
+        elif hashes[todo_id] != old_hashes[todo_id]:
+            # The fields of archived todos are not kept, so a reopened one
+            # only reports that it is no longer completed
+            if todo_id in old_todos:
+                old = old_todos[todo_id]
+                fields = field_changes(old, todo)
+            else:
+                old = {'completed': True}
+                fields = {'completed': [True, todo.get('completed')]}
+            if todo.get('completed') and not old.get('completed'):
+                event['completed'].append({'id': todo_id,
+                                           'text': todo['text']})
+                fields.pop('completed', None)
+                fields.pop('dateCompleted', None)
+            if fields:
+                event['changed'].append({'id': todo_id,
+                                         'text': todo['text'],
+                                         'fields': fields})
+    for todo_id in set(old_hashes) - set(hashes):
+        old = old_todos.get(todo_id, {})
+        event['deleted'].append({'id': todo_id, 'text': old.get('text')})
+
+    old_stats = old_state['stats']
+    event['stats'] = dict((key, stats[key] - old_stats[key])
+                          for key in STAT_KEYS
+                          if key in stats and key in old_stats and
+                          stats[key] != old_stats[key])
+
+    state = {'hashes': hashes, 'todos': new_todos,
+             'stats': dict((key, stats.get(key)) for key in STAT_KEYS)}
+    if not any(event.values()):
+        return state, None
+    return state, event
+
+
+class ChangeFeed(object):
+    """The change log and last-sync state of a profile, in the cache."""
+    def __init__(self, profile=None):
+        self.profile = profile
+        self.state_filename = get_cache_filename(".habit_changes.p", profile)
+        self.log_filename = get_cache_filename(".habit_changes.ndjson",
+                                               profile)
+
+    def _load_state(self):
+        """Load the state of the last sync, or None."""
+        try:
+            with open(self.state_filename, 'rb') as state_file:
+                return pickle.load(state_file)
+        except Exception:  # pylint: disable=broad-except
+            return None
+
+    def _save_state(self, state):
+        """Save the state of this sync."""
+        with open(self.state_filename + ".tmp", 'wb') as state_file:
+            pickle.dump(state, state_file, pickle.HIGHEST_PROTOCOL)
+        os.rename(self.state_filename + ".tmp", self.state_filename)
+
+    def publish(self, todos, stats, hook=None):
+        """
+        Diff a sync against the last one, and log and hand the event to the
+        hook command if anything changed. The hook is not waited for. The
+        first sync only records the state. Returns the event or None.
+        """
+        old_state = self._load_state()
+        state, event = diff_sync(old_state or EMPTY_STATE, todos, stats)
+        self._save_state(state)
+        if old_state is None or event is None:
+            return None
+
+        event['time'] = time.time()
+        event['profile'] = self.profile
+        line = json.dumps(event, sort_keys=True)
+        with open(self.log_filename, 'a') as log_file:
+            log_file.write(line + "\n")
+        if hook:
+            # A temporary file as stdin lets the hook read the event at its
+            # own pace after this process has moved on
+            with tempfile.TemporaryFile() as event_file:
+                event_file.write(line + "\n")
+                event_file.seek(0)
+                subprocess.Popen(hook, shell=True, stdin=event_file)
+        return event
@@ -0,0 +1,203 @@
+"""
+Shell tab completion served from a local index of todos and tags.
+
+This module is imported before anything else when the shell asks for
+completions, so it must stay cheap: it reads a small JSON index written on
+each sync and never touches the network or the heavier habitcli modules.
+"""
+
+import argparse
+import glob
+import json
+import os
+import sys
+
+
+# Kept in step with habitcli.utils.CACHE_DIR and get_cache_filename, which
+# are not imported here because habitcli.utils pulls in yaml, dateutil and
+# parsedatetime.
+CACHE_DIR = os.environ.get('HABIT_CACHE_DIR',
+                           os.path.dirname(os.path.realpath(__file__)))
+
+
+def get_index_filename(profile=None):
+    """Return the path of the completion index for a profile."""
+    if profile:
+        return os.path.join(CACHE_DIR, ".habit-%s_index.json" % profile)
+    return os.path.join(CACHE_DIR, ".habit_index.json")
+
+
+def write_index(user, profile=None):
+    """Write the completion index for a freshly synced user."""
+    todos = []
+    checklist = []
+    for todo in user['todos']:
+        if todo.get('completed'):
+            continue
+        todos.append(todo['text'])
+        for item in todo.get('checklist', []):
+            if not item.get('completed'):
+                checklist.append(item['text'])
+    index = {'todos': todos,
+             'checklist': checklist,
+             'habits': [habit['text'] for habit in user.get('habits', [])],
+             'dailys': [daily['text'] for daily in user.get('dailys', [])],
+             'tags': sorted(user['reverse_tag_dict'].keys())}
+
+    index_filename = get_index_filename(profile)
+    with open(index_filename + ".tmp", 'w') as index_file:
+        json.dump(index, index_file)
+    os.rename(index_filename + ".tmp", index_filename)
+
+
+def read_index(parsed_args=None):
+    """
+    Read the completion index of the profile being completed, merging all
+    of them for '--profile all'. Missing indexes are treated as empty.
+    """
+    profile = getattr(parsed_args, 'profile', None)
+    if profile == 'all':
+        filenames = glob.glob(os.path.join(CACHE_DIR, ".habit*_index.json"))
+    else:
+        filenames = [get_index_filename(profile)]
+
+    index = {'todos': [], 'checklist': [], 'habits': [], 'dailys': [],
+             'tags': []}
+    for filename in filenames:
+        try:
+            with open(filename, 'r') as index_file:
+                for key, values in json.load(index_file).items():
+                    index[key].extend(values)
+        except (IOError, ValueError):
+            pass
+    return index
+
+
+def todo_completer(parsed_args=None, **kwargs):
+    """Complete incomplete todo texts."""
+    return read_index(parsed_args)['todos']
+
+
+def todo_or_check_completer(parsed_args=None, **kwargs):
+    """Complete incomplete todo and checklist item texts."""
+    index = read_index(parsed_args)
+    return index['todos'] + index['checklist']
+
+
+def habit_completer(parsed_args=None, **kwargs):
+    """Complete habit texts."""
+    return read_index(parsed_args)['habits']
+
+
+def daily_completer(parsed_args=None, **kwargs):
+    """Complete daily texts."""
+    return read_index(parsed_args)['dailys']
+
+
+def tag_completer(parsed_args=None, **kwargs):
+    """Complete '+tag' arguments."""
+    return ["+" + tag for tag in sorted(set(read_index(parsed_args)['tags']))]
+
+
+def substring_validator(completion, prefix):
+    """Accept completions containing the typed text anywhere."""
+    return prefix.lower() in completion.lower()
+
+
+def make_parser():
+    """
+    Build a lightweight parser mirroring the positional arguments of the
+    habit commands, for use by argcomplete only.
+    """
+    parser = argparse.ArgumentParser(prog='habit')
+    parser.add_argument('--profile')
+    subparsers = parser.add_subparsers()
+
+    ls_parser = subparsers.add_parser('ls')
+    ls_parser.add_argument('--raw', action='store_true')
+    ls_parser.add_argument('--completed', action='store_true')
+    ls_parser.add_argument('--list-tasks', action='store_true')
+    ls_parser.add_argument('query', nargs='*').completer = tag_completer
+
+    stats_parser = subparsers.add_parser('stats')
+    stats_parser.add_argument('--watch', action='store_true')
+    stats_parser.add_argument('--interval')
+    stats_parser.add_argument('--output')
+    stats_parser.add_argument('--history')
+
+    search_parser = subparsers.add_parser('search')
+    search_parser.add_argument('--limit')
+    search_parser.add_argument('query', nargs='*')
+
+    agenda_parser = subparsers.add_parser('agenda')
+    agenda_parser.add_argument('--from')
+    agenda_parser.add_argument('--to')
+    agenda_parser.add_argument('--counts', action='store_true')
+
+    add_parser = subparsers.add_parser('add')
+    add_parser.add_argument('--due-date')
+    add_parser.add_argument('--plan-date')
+    add_parser.add_argument('todo')
+    add_parser.add_argument('tags', nargs='*').completer = tag_completer
+
+    import_parser = subparsers.add_parser('import')
+    import_parser.add_argument('--workers')
+    import_parser.add_argument('--rate')
+    import_parser.add_argument('--restart', action='store_true')
+    import_parser.add_argument('filename')
+
+    addcheck_parser = subparsers.add_parser('addcheck')
+    addcheck_parser.add_argument('check')
+    addcheck_parser.add_argument('parent_str').completer = todo_completer
+
+    for command in ['do', 'delete']:
+        command_parser = subparsers.add_parser(command)
+        command_parser.add_argument('todos', nargs='*').completer = \
+            todo_or_check_completer
+        if command == 'do':
+            command_parser.add_argument('--multi', action='store_true')
+
+    score_parser = subparsers.add_parser('score')
+    score_parser.add_argument('--down', action='store_true')
+    score_parser.add_argument('habits', nargs='*').completer = habit_completer
+
+    daily_parser = subparsers.add_parser('daily')
+    daily_parser.add_argument('--undo', action='store_true')
+    daily_parser.add_argument('dailies', nargs='*').completer = \
+        daily_completer
+
+    dedupe_parser = subparsers.add_parser('dedupe')
+    dedupe_parser.add_argument('--threshold')
+    dedupe_parser.add_argument('--merge', action='store_true')
+
+    remind_parser = subparsers.add_parser('remind')
+    remind_parser.add_argument('--command')
+    remind_parser.add_argument('--lead')
+    remind_parser.add_argument('--sync-interval')
+
+    detail_parser = subparsers.add_parser('detail')
+    detail_parser.add_argument('todo_string').completer = \
+        todo_or_check_completer
+
+    plan_parser = subparsers.add_parser('plan')
+    plan_parser.add_argument('todo').completer = todo_or_check_completer
+    plan_parser.add_argument('planned_date')
+
+    gui_parser = subparsers.add_parser('gui')
+    gui_parser.add_argument('--refresh')
+    gui_parser.add_argument('tags', nargs='*').completer = tag_completer
+
+    return parser
+
+
+def autocomplete():
+    """
+    Answer a shell completion request and exit, if this process is one.
+
+    Does nothing when the shell is not asking for completions.
+    """
+    if '_ARGCOMPLETE' not in os.environ or \
+            not os.path.basename(sys.argv[0]).startswith('habit'):
+        return
+    import argcomplete
+    argcomplete.autocomplete(make_parser(), validator=substring_validator)
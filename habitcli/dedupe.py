@@ -0,0 +1,130 @@
+"""
+Near-duplicate todo detection.
+
+Comparing every pair of todos is quadratic, so todos are first grouped into
+blocks that share a primary tag and a word, and only pairs within a block
+are scored. Words shared by too many todos make poor blocking keys and are
+skipped. The candidate pairs are scored in batches, spread over a process
+pool when there are enough of them, and pairs above the threshold are
+joined into clusters of duplicates.
+"""
+
+import re
+from multiprocessing import Pool
+
+from fuzzywuzzy import fuzz
+
+
+WORD_RE = re.compile(r'\w{3,}', re.UNICODE)
+
+# Blocks larger than this are skipped as too common to be informative
+MAX_BLOCK_SIZE = 50
+
+# Pairs per batch sent to a worker process
+BATCH_SIZE = 500
+
+
+def blocking_keys(text, tag):
+    """Return the blocking keys of a todo: its words within its tag."""
+    return set((tag, word) for word in WORD_RE.findall(text.lower()))
+
+
+def candidate_pairs(todos, tags):
+    """
+    Return the sorted (i, j) index pairs of todos sharing a blocking key.
+    'tags' gives the primary tag of each todo.
+    """
+    blocks = {}
+    for index, (todo, tag) in enumerate(zip(todos, tags)):
+        for key in blocking_keys(todo['text'], tag):
+            blocks.setdefault(key, []).append(index)
+
+    pairs = set()
+    for members in blocks.values():
+        if len(members) > MAX_BLOCK_SIZE:
+            continue
+        for position, first in enumerate(members):
+            for second in members[position + 1:]:
+                pairs.add((first, second))
+    return sorted(pairs)
+
+
+def score_batch(text_pairs):
+    """Score a batch of (text, text) pairs from 0 to 100."""
+    return [fuzz.token_sort_ratio(first, second)
+            for first, second in text_pairs]
+
+
+def score_pairs(text_pairs, processes=None):
+    """
+    Score (text, text) pairs in batches, using a process pool when there
+    is more than one batch.
+    """
+    batches = [text_pairs[start:start + BATCH_SIZE]
+               for start in range(0, len(text_pairs), BATCH_SIZE)]
+    if len(batches) <= 1:
+        return score_batch(text_pairs)
+    pool = Pool(processes)
+    try:
+        scored = pool.map(score_batch, batches)
+    finally:
+        pool.close()
+        pool.join()
+    return [score for batch in scored for score in batch]
+
+
+def find_duplicates(todos, tags, threshold=85, processes=None):
+    """
+    Find clusters of near-duplicate todos.
+
+    Returns a list of clusters, each a list of (index, best score) pairs
+    with the todo to keep first: the one with the longest checklist, then
+    the oldest.
+    """
+    pairs = candidate_pairs(todos, tags)
+    scores = score_pairs([(todos[i]['text'], todos[j]['text'])
+                          for i, j in pairs], processes)
+
+    # Union-find over the pairs that score above the threshold
+    parents = {}
+
+    def find(index):
+        """Return the root of an index's cluster."""
+        while parents.get(index, index) != index:
+            index = parents[index]
+        return index
+
+    best = {}
+    for (first, second), score in zip(pairs, scores):
+        if score < threshold:
+            continue
+        parents[find(second)] = find(first)
+        best[first] = max(best.get(first, 0), score)
+        best[second] = max(best.get(second, 0), score)
+
+    clusters = {}
+    for index in best:
+        clusters.setdefault(find(index), []).append(index)
+
+    keep_key = lambda index: (-len(todos[index].get('checklist', [])),
+                              todos[index].get('dateCreated', ''))
+    return [[(index, best[index]) for index in sorted(members, key=keep_key)]
+            for members in clusters.values()]
+
+
+def merge_checklists(keep, duplicates):
+    """
+    Add the checklist items of the duplicates that the kept todo lacks.
+    Returns True if the kept todo changed.
+    """
+    checklist = list(keep.get('checklist', []))
+    texts = set(item['text'] for item in checklist)
+    for duplicate in duplicates:
+        for item in duplicate.get('checklist', []):
+            if item['text'] not in texts:
+                checklist.append(item)
+                texts.add(item['text'])
+    if len(checklist) == len(keep.get('checklist', [])):
+        return False
+    keep['checklist'] = checklist
+    return True
@@ -6,10 +6,10 @@ class NoSuchTagException(Exception):
     def __init__(self, tag, valid_tags):
         Exception.__init__(self)
         self.tag = tag
-        self.tag = valid_tags
+        self.valid_tags = valid_tags
 
     def __str__(self):
-        return "Tag '%s' does not exist" % self.value
+        return "Tag '%s' does not exist" % self.tag
 
 
 class MultipleTasksException(Exception):
@@ -42,3 +42,14 @@ class DateFormatException(Exception):
 
     def __str__(self):
         return repr(self.value)
+
+
+class HabitAPIError(Exception):
+    """Exception for an API request that the server rejected."""
+    def __init__(self, status, error):
+        Exception.__init__(self)
+        self.status = status
+        self.error = error
+
+    def __str__(self):
+        return "HabitRPG error %s: %s" % (self.status, self.error)
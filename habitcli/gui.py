@@ -1,8 +1,10 @@
 """A GUI table-based todo editor for the HabitCLI interface."""
 # Standard lib imports
+import Queue
 import Tkinter as tk
 import tkMessageBox
 import ttk
+from multiprocessing.pool import ThreadPool
 
 # Same-project imports
 import habitcli
@@ -14,13 +16,125 @@ class ValueStore(object):
     pass
 
 
+class SaveWorker(object):
+    """
+    Run API calls on a background pool so the Tk event loop never blocks.
+
+    Results are queued rather than delivered by callback, since Tk may only
+    be touched from the main thread; the table drains the queue with after().
+    """
+    def __init__(self, workers=4):
+        self.pool = ThreadPool(workers)
+        self.results = Queue.Queue()
+
+    def submit(self, row, func, *args):
+        """Call func(*args) in the background on behalf of a row."""
+        def job():
+            """Run the call, capturing any error for the main thread."""
+            try:
+                return row, func(*args), None
+            except Exception as err:  # pylint: disable=broad-except
+                return row, None, err
+        self.pool.apply_async(job, callback=self.results.put)
+
+    def drain(self):
+        """Return the (row, result, error) triples finished so far."""
+        finished = []
+        while True:
+            try:
+                finished.append(self.results.get_nowait())
+            except Queue.Empty:
+                return finished
+
+
+class RowState(object):
+    """
+    The editable state of one todo in the table.
+
+    The dates and tag are only computed the first time the row is scrolled
+    into view, and edits are kept here so they survive widget recycling.
+    """
+    def __init__(self, datum):
+        self.datum = datum
+        self.original = None
+        self.values = None
+        # None, 'pending' while a save is in flight, or 'failed'
+        self.status = None
+        self.error = None
+
+    def load(self, reset=False):
+        """Compute the original and displayed values, if not done already."""
+        if self.original is not None and not reset:
+            return
+        primary_tag = self.datum.get_primary_tag()
+        self.original = {'tag': primary_tag if primary_tag else "",
+                         'plan': self.datum.get_planning_date(),
+                         'due': self.datum.get_due_date()}
+        self.values = {'tag': self.original['tag'],
+                       'plan': utils.format_date(self.original['plan']),
+                       'due': utils.format_date(self.original['due'])}
+
+    def refresh_original(self):
+        """
+        Recompute the original values after the todo changed on the server,
+        keeping any fields the user has edited but not saved.
+        """
+        if self.original is None:
+            return
+        shown = {'tag': self.original['tag'],
+                 'plan': utils.format_date(self.original['plan']),
+                 'due': utils.format_date(self.original['due'])}
+        edited = dict((key, value) for key, value in self.values.items()
+                      if value != shown[key])
+        self.load(reset=True)
+        self.values.update(edited)
+
+
+def is_incomplete(todo):
+    """The default table filter: show only incomplete todos."""
+    return 'completed' in todo.keys() and not todo['completed']
+
+
+class RowSlot(object):
+    """One recyclable row of widgets, bound to at most one RowState."""
+    def __init__(self, label, tag, plan, due, btn):
+        self.label = label
+        self.tag = tag
+        self.plan = plan
+        self.due = due
+        self.btn = btn
+        self.row = None
+
+    def widgets(self):
+        """All the widgets in the slot, in column order."""
+        return [self.label, self.tag, self.plan, self.due, self.btn]
+
+
 class SimpleTableInput(tk.Frame):
-    """Table layout for the todo editor."""
-    def __init__(self, parent, hcli, data):
+    """
+    Table layout for the todo editor.
+
+    Only enough rows of widgets to fill the window are created; scrolling
+    rebinds them to different todos rather than creating new widgets.
+    """
+    def __init__(self, parent, hcli, data, visible_rows=25, todo_filter=None):
         tk.Frame.__init__(self, parent)
 
         self.hcli = hcli
         self.data = data
+        self.todo_filter = todo_filter if todo_filter else is_incomplete
+        self.visible_rows = visible_rows
+        self.rows = [RowState(datum) for datum in data]
+        self.first = 0
+        self.slots = []
+        self.worker = SaveWorker(
+            int(hcli.config.get('max_concurrency', 8)))
+        self.pending = 0
+        # The rows of the current 'Save all', and those that failed
+        self.batch = set()
+        self.batch_failures = []
+        self.refreshing = False
+        self.polling = False
 
         # Register a command to use for validation
         self.val_tag = (self.register(self._val_tag), '%P', '%W')
@@ -32,140 +146,424 @@ class SimpleTableInput(tk.Frame):
         self.ex_val = (self.register(self.example_validate),
                        '%d', '%i', '%P', '%s', '%S', '%v', '%V', '%W')
 
-        # Create the table of widgets
-        for row, datum in enumerate(self.data):
-            label = self._add_label(datum, row)
-            tag = self._add_tag_field(datum, row)
-            plan = self._add_plan_field(datum, row)
-            due = self._add_due_field(datum, row)
-            self._add_btn(datum, row, label, tag, plan, due)
+        self.scrollbar = tk.Scrollbar(self,
+                                      orient="vertical",
+                                      command=self._on_scroll)
+        self.scrollbar.grid(row=0, column=5, rowspan=visible_rows + 1,
+                            sticky="ns")
+
+        # Create the recyclable rows of widgets
+        self._add_slots()
 
         # adjust column weights so they all expand equally
         for column in range(5):
             self.grid_columnconfigure(column, weight=1)
-        # designate a final, empty row to fill up any extra space
-        self.grid_rowconfigure(len(self.data), weight=1)
 
-    def _add_label(self, datum, row):
-        """Add a label for the given todo."""
-        label = tk.Label(self, text=datum['text'])
+        for sequence in ["<MouseWheel>", "<Button-4>", "<Button-5>"]:
+            self.bind_all(sequence, self._on_wheel)
+
+        self._redraw()
+
+    def _add_slots(self):
+        """Add slots until there is one per visible row."""
+        self.grid_rowconfigure(len(self.slots), weight=0)
+        while len(self.slots) < min(self.visible_rows, len(self.rows)):
+            self._add_slot()
+        # designate a final, empty row to fill up any extra space
+        self.grid_rowconfigure(len(self.slots), weight=1)
+
+    def _add_slot(self):
+        """Add a row of widgets to the bottom of the table."""
+        row = len(self.slots)
+        label = self._add_label(row)
+        tag = self._add_tag_field(row)
+        plan = self._add_plan_field(row)
+        due = self._add_due_field(row)
+        slot = RowSlot(label, tag, plan, due, None)
+        slot.btn = self._add_btn(slot, row)
+        self.slots.append(slot)
+
+    def _add_label(self, row):
+        """Add a label for the todo text."""
+        label = tk.Label(self, anchor="w")
         label.grid(row=row, column=0, sticky="w")
         return label
 
-    def _add_tag_field(self, datum, row):
-        """Add a primary tag field for the given todo."""
+    def _add_tag_field(self, row):
+        """Add a primary tag field."""
         tag = ttk.Combobox(self,
                            values=self.hcli.config['tasks']+[''],
                            validate='all',
                            validatecommand=self.val_tag)
-        primary_tag = datum.get_primary_tag()
-        tag.set(primary_tag if primary_tag else "")
-        tag.original = primary_tag
+        tag.original = ""
         tag.grid(row=row, column=1, sticky="nsew")
         return tag
 
-    def _add_plan_field(self, datum, row):
-        """Add a plan date field for the given todo."""
-        plan_date = datum.get_planning_date()
-        plan_date_str = utils.format_date(plan_date)
+    def _add_plan_field(self, row):
+        """Add a plan date field."""
         plan = tk.Entry(self, validate="all", validatecommand=self.val_date)
-        plan.insert(0, plan_date_str)
-        if utils.is_past(plan_date):
-            plan['background'] = 'red'
-        plan.original = plan_date
+        plan.original = None
         plan.grid(row=row, column=2, sticky="nsew")
         return plan
 
-    def _add_due_field(self, datum, row):
-        """Add a due date field for the given todo."""
-        due_date = datum.get_due_date()
-        due_str = utils.format_date(due_date)
+    def _add_due_field(self, row):
+        """Add a due date field."""
         due = tk.Entry(self, validate="all", validatecommand=self.val_date)
-        due.insert(0, due_str)
-        if utils.is_past(due_date):
-            due['background'] = 'red'
-        due.original = due_date
+        due.original = None
         due.grid(row=row, column=3, sticky="nsew")
         return due
 
-    def _add_btn(self, datum, row, label, tag, plan, due):
-        """Add update button for the given todo."""
-        def btn_callback():
-            """Update the associated todo with the changed fields."""
-            fragments = []
-            updates = {}
-
-            date_fmt_str = "%s:\n\tFrom: %s\n\tTo:     %s"
-
-            # Changes in planning date
-            if plan.get():
-                old_plan = datum.get_planning_date()
-                new_plan = utils.parse_datetime(plan.get())
-                if new_plan != old_plan:
-                    fragments.append(date_fmt_str %
-                                     ('Plan Date',
-                                      utils.format_date(old_plan),
-                                      utils.format_date(new_plan)))
-                    updates['plan'] = new_plan
-
-            # Changes in due date
-            if due.get():
-                old_due = datum.get_due_date()
-                new_due = utils.parse_datetime(due.get())
-                if new_due != old_due:
-                    fragments.append(date_fmt_str %
-                                     ('Due Date',
-                                      utils.format_date(old_due),
-                                      utils.format_date(new_due)))
-                    updates['due'] = new_due
-
-            # Changes in tag
-            old_tag = datum.get_primary_tag()
-            new_tag = tag.get()
-            if new_tag != old_tag:
-                fragments.append("Tag:\n\tFrom: %s\n\tTo: %s" %
-                                 (old_tag, new_tag))
-                updates['tag'] = new_tag
-
-            if fragments:
-                message = "\n".join(fragments)
-                if tkMessageBox.askyesno("Update %s?" %
-                                         datum['text'], message):
-
-                    if 'tag' in updates:
-                        datum.set_primary_tag(updates['tag'])
-                    if 'plan' in updates:
-                        datum.set_planning_date(updates['plan'])
-                    if 'due' in updates:
-                        datum.set_due_date(updates['due'])
-
-                    datum.update_db()
-
-                    tag.original = datum.get_primary_tag()
-                    tag.original = tag.original if tag.original else ""
-                    tag.set(tag.original)
-                    self._val_tag(tag.get(), tag)
-
-                    plan.delete(0, 1000)
-                    plan.original = datum.get_planning_date()
-                    plan.insert(0, utils.format_date(plan.original))
-                    self._validate_date(plan.get(), 'focusout', plan, 'all')
-
-                    due.delete(0, 1000)
-                    due.original = datum.get_due_date()
-                    due.insert(0, utils.format_date(due.original))
-                    self._validate_date(due.get(), 'focusout', due, 'all')
-
-                    print datum['text'], "updated!"
-
+    def _add_btn(self, slot, row):
+        """Add update button for the todo bound to the slot."""
         btn = tk.Button(self,
                         text="Update",
                         takefocus=True,
                         highlightbackground="BLUE",
-                        command=btn_callback)
+                        command=lambda: self._update_row(slot))
         btn.grid(row=row, column=4, sticky="nsew")
         return btn
 
+    def _store_slot(self, slot):
+        """Copy any edits in the slot's widgets back to its RowState."""
+        if slot.row:
+            slot.row.values = {'tag': slot.tag.get(),
+                               'plan': slot.plan.get(),
+                               'due': slot.due.get()}
+
+    def _bind_slot(self, slot, row):
+        """Show the given RowState in the slot's widgets."""
+        row.load()
+        slot.row = row
+        slot.label['text'] = row.datum['text']
+
+        slot.tag.original = row.original['tag']
+        slot.tag.set(row.values['tag'])
+        self._val_tag(slot.tag.get(), slot.tag)
+
+        for widget, key in [(slot.plan, 'plan'), (slot.due, 'due')]:
+            widget.original = row.original[key]
+            widget.delete(0, 1000)
+            widget.insert(0, row.values[key])
+            if row.values[key] != utils.format_date(row.original[key]):
+                widget['background'] = 'green'
+            elif utils.is_past(row.original[key]):
+                widget['background'] = 'red'
+            else:
+                widget['background'] = 'systemWindowBody'
+
+        if row.status == 'pending':
+            slot.label['foreground'] = 'gray'
+            slot.btn.config(text="Saving...", state="disabled")
+        elif row.status == 'failed':
+            slot.label['foreground'] = 'red'
+            slot.btn.config(text="Retry", state="normal")
+        else:
+            slot.label['foreground'] = 'black'
+            slot.btn.config(text="Update", state="normal")
+
+    def _refresh_row(self, row):
+        """Rebind the slot showing the given row, if it is visible."""
+        for slot in self.slots:
+            if slot.row is row:
+                self._store_slot(slot)
+                self._bind_slot(slot, row)
+
+    def _redraw(self):
+        """Rebind every slot to the rows starting at self.first."""
+        for index, slot in enumerate(self.slots):
+            self._store_slot(slot)
+            if self.first + index < len(self.rows):
+                self._bind_slot(slot, self.rows[self.first + index])
+                # Restores the grid options remembered by grid_remove()
+                for widget in slot.widgets():
+                    widget.grid()
+            else:
+                slot.row = None
+                for widget in slot.widgets():
+                    widget.grid_remove()
+
+        if self.rows:
+            self.scrollbar.set(
+                float(self.first) / len(self.rows),
+                float(self.first + len(self.slots)) / len(self.rows))
+
+    def scroll_to(self, first):
+        """Scroll so that the row at index 'first' is at the top."""
+        first = max(0, min(first, len(self.rows) - len(self.slots)))
+        if first != self.first:
+            self.first = first
+            self._redraw()
+
+    def _on_scroll(self, action, amount, units=None):
+        """Handle scrollbar commands."""
+        if action == "moveto":
+            self.scroll_to(int(float(amount) * len(self.rows)))
+        elif action == "scroll":
+            step = len(self.slots) if units == "pages" else 1
+            self.scroll_to(self.first + int(amount) * step)
+
+    def _on_wheel(self, event):
+        """Scroll three rows per mouse wheel notch."""
+        if event.num == 4 or event.delta > 0:
+            self.scroll_to(self.first - 3)
+        else:
+            self.scroll_to(self.first + 3)
+
+    def _update_row(self, slot):
+        """Update the todo bound to the slot with the changed fields."""
+        row = slot.row
+        if not row or row.status == 'pending':
+            return
+        self._store_slot(slot)
+
+        # The todo was already changed locally; just resend it
+        if row.status == 'failed':
+            self._save_row(row)
+            return
+
+        fragments, updates = self._collect_updates(row)
+        if fragments:
+            message = "\n".join(fragments)
+            if tkMessageBox.askyesno("Update %s?" %
+                                     row.datum['text'], message):
+                self._apply_updates(row, updates)
+                self._save_row(row)
+
+    def _collect_updates(self, row):
+        """
+        Compare the row's edited values against its todo.
+
+        Returns a list of human-readable change descriptions and a dict of
+        the parsed new values, keyed by 'tag', 'plan' and 'due'.
+        """
+        datum = row.datum
+        fragments = []
+        updates = {}
+
+        date_fmt_str = "%s:\n\tFrom: %s\n\tTo:     %s"
+
+        # Changes in planning date
+        if row.values['plan']:
+            old_plan = datum.get_planning_date()
+            new_plan = utils.parse_datetime(row.values['plan'])
+            if new_plan != old_plan:
+                fragments.append(date_fmt_str %
+                                 ('Plan Date',
+                                  utils.format_date(old_plan),
+                                  utils.format_date(new_plan)))
+                updates['plan'] = new_plan
+
+        # Changes in due date
+        if row.values['due']:
+            old_due = datum.get_due_date()
+            new_due = utils.parse_datetime(row.values['due'])
+            if new_due != old_due:
+                fragments.append(date_fmt_str %
+                                 ('Due Date',
+                                  utils.format_date(old_due),
+                                  utils.format_date(new_due)))
+                updates['due'] = new_due
+
+        # Changes in tag
+        old_tag = datum.get_primary_tag()
+        new_tag = row.values['tag']
+        if new_tag != (old_tag if old_tag else ""):
+            fragments.append("Tag:\n\tFrom: %s\n\tTo: %s" %
+                             (old_tag, new_tag))
+            updates['tag'] = new_tag
+
+        return fragments, updates
+
+    @staticmethod
+    def _apply_updates(row, updates):
+        """Apply parsed updates to the row's todo, without saving it."""
+        datum = row.datum
+        if 'tag' in updates:
+            datum.set_primary_tag(updates['tag'])
+        if 'plan' in updates:
+            datum.set_planning_date(updates['plan'])
+        if 'due' in updates:
+            datum.set_due_date(updates['due'])
+
+    def dirty_rows(self):
+        """Return the rows whose edited values differ from their todo."""
+        for slot in self.slots:
+            self._store_slot(slot)
+        return [row for row in self.rows
+                if row.values is not None and row.status != 'pending' and
+                (row.status == 'failed' or
+                 row.values['tag'] != row.original['tag'] or
+                 row.values['plan'] !=
+                 utils.format_date(row.original['plan']) or
+                 row.values['due'] != utils.format_date(row.original['due']))]
+
+    def save_all(self):
+        """Confirm and save every changed row at once."""
+        changed = []
+        fragments = []
+        for row in self.dirty_rows():
+            if row.status == 'failed':
+                changed.append((row, {}))
+                fragments.append("%s: retry failed save" % row.datum['text'])
+                continue
+            try:
+                row_fragments, updates = self._collect_updates(row)
+            except utils.DateParseException as err:
+                fragments.append("%s: skipped, %s" % (row.datum['text'], err))
+                continue
+            if updates:
+                changed.append((row, updates))
+                fragments.append(row.datum['text'])
+                fragments.extend("    " + fragment.replace("\n", "\n    ")
+                                 for fragment in row_fragments)
+
+        if not changed:
+            tkMessageBox.showinfo("Save all", "Nothing to save.")
+            return
+
+        # Keep the dialog a manageable size
+        if len(fragments) > 40:
+            fragments = fragments[:40] + ["...and more"]
+        if not tkMessageBox.askyesno("Save %d todos?" % len(changed),
+                                     "\n".join(fragments)):
+            return
+
+        self.batch = set()
+        self.batch_failures = []
+        for row, updates in changed:
+            self._apply_updates(row, updates)
+            self.batch.add(row)
+            self._save_row(row)
+
+    def _save_row(self, row):
+        """Send the row's todo to the server in the background."""
+        row.status = 'pending'
+        row.error = None
+        self.worker.submit(row, self.hcli.api.update_task,
+                           row.datum['id'], dict(row.datum))
+        self.pending += 1
+        self._schedule_poll()
+        self._refresh_row(row)
+
+    def _schedule_poll(self):
+        """Start polling for background results, if not already."""
+        if not self.polling:
+            self.polling = True
+            self.after(100, self._poll_results)
+
+    def _poll_results(self):
+        """Apply the finished saves, polling again while any are pending."""
+        for row, result, error in self.worker.drain():
+            if row is None:
+                self._apply_refresh(result, error)
+                continue
+            self.pending -= 1
+            if not error and result and 'err' in result:
+                error = result['err']
+            if error:
+                row.status = 'failed'
+                row.error = str(error)
+                print row.datum['text'], "failed to update:", row.error
+            else:
+                row.datum._update(result)  # pylint: disable=protected-access
+                row.status = None
+                row.load(reset=True)
+                print row.datum['text'], "updated!"
+            self._refresh_row(row)
+
+            if row in self.batch:
+                self.batch.discard(row)
+                if row.status == 'failed':
+                    self.batch_failures.append(row)
+                if not self.batch:
+                    self._report_batch()
+
+        if self.pending or self.refreshing:
+            self.after(100, self._poll_results)
+        else:
+            self.polling = False
+
+    def refresh(self):
+        """Fetch the user in the background and patch the table with it."""
+        if self.refreshing:
+            return
+        self.refreshing = True
+        self.worker.submit(None, self.hcli.api.user, habitcli.USER_FIELDS)
+        self._schedule_poll()
+
+    def _apply_refresh(self, raw_user, error):
+        """
+        Patch the table with a freshly fetched user.
+
+        Rows are matched by todo ID: changed todos are updated in place
+        (keeping any unsaved edits), new ones are added and deleted or
+        completed ones are removed. The top visible row stays on top.
+        """
+        self.refreshing = False
+        if error or not raw_user or 'err' in raw_user:
+            print "Refresh failed:", error or (raw_user or {}).get('err')
+            return
+
+        for slot in self.slots:
+            self._store_slot(slot)
+        anchor = self.rows[self.first] if self.rows else None
+
+        user = self.hcli.get_user()
+        existing = dict((todo['id'], todo) for todo in user['todos'])
+        rows_by_id = dict((row.datum['id'], row) for row in self.rows)
+
+        todos = []
+        changed = added = 0
+        for raw_todo in raw_user['todos']:
+            if habitcli.is_archived(raw_todo):
+                continue
+            todo = existing.get(raw_todo['id'])
+            if todo is None:
+                todo = habitcli.Todo(raw_todo, hcli=self.hcli)
+                added += 1
+            elif todo.store != raw_todo and \
+                    not getattr(rows_by_id.get(todo['id']), 'status', None):
+                # Rows with saves pending or failed keep their local todo
+                # pylint: disable=protected-access
+                todo._update(raw_todo)
+                changed += 1
+                if todo['id'] in rows_by_id:
+                    rows_by_id[todo['id']].refresh_original()
+            todos.append(todo)
+        removed = len(set(existing) - set(t['id'] for t in todos))
+
+        # The snapshot ordering is stale once anything has changed
+        user.pop('order', None)
+        user['todos'] = todos
+        user['stats'] = raw_user.get('stats', user.get('stats'))
+
+        visible = [todo for todo in todos if self.todo_filter(todo)]
+        visible_ids = set(todo['id'] for todo in visible)
+        self.data = self.hcli.sort_nicely(
+            [row.datum for row in self.rows
+             if row.datum['id'] in visible_ids or row.status == 'pending'] +
+            [todo for todo in visible if todo['id'] not in rows_by_id])
+        self.rows = [rows_by_id.get(todo['id']) or RowState(todo)
+                     for todo in self.data]
+
+        self._add_slots()
+        if anchor in self.rows:
+            self.first = self.rows.index(anchor)
+        self.scroll_to(self.first)
+        self._redraw()
+        print "Refreshed: %d changed, %d added, %d removed" % \
+            (changed, added, removed)
+
+    def _report_batch(self):
+        """Report the rows of the finished 'Save all' that failed."""
+        if self.batch_failures:
+            lines = ["%s: %s" % (row.datum['text'], row.error)
+                     for row in self.batch_failures]
+            tkMessageBox.showerror("%d saves failed" %
+                                   len(self.batch_failures),
+                                   "\n".join(lines[:40]))
+        self.batch_failures = []
+
     def example_validate(self, d, i, P, s, S, v, V, W):
         """An example validation showing all the arguments."""
         print "OnValidate:"
@@ -230,14 +628,38 @@ class SimpleTableInput(tk.Frame):
 
 class TodoFrame(tk.Frame):
     """A tk Frame wrapper for the todos."""
-    def __init__(self, parent, hcli, data):
+    def __init__(self, parent, hcli, data, todo_filter=None, refresh=0):
         tk.Frame.__init__(self, parent)
-        self.table = SimpleTableInput(self, hcli, data)
+        self.toolbar = tk.Frame(self)
+        self.toolbar.pack(side="top", fill="x")
+        self.table = SimpleTableInput(self, hcli, data,
+                                      todo_filter=todo_filter)
         self.table.pack(side="top", fill="both", expand=True)
 
+        tk.Button(self.toolbar,
+                  text="Save all",
+                  command=self.table.save_all).pack(side="right")
+        tk.Button(self.toolbar,
+                  text="Refresh",
+                  command=self.table.refresh).pack(side="right")
+
+        self.refresh_interval = refresh
+        if refresh:
+            self.after(int(refresh * 1000), self._auto_refresh)
+
+    def _auto_refresh(self):
+        """Refresh the table, then schedule the next refresh."""
+        self.table.refresh()
+        self.after(int(self.refresh_interval * 1000), self._auto_refresh)
 
-def make_gui(hcli=None, todos=None):
-    """Show a graphical window where the todos can be editted."""
+
+def make_gui(hcli=None, todos=None, todo_filter=None, refresh=0):
+    """
+    Show a graphical window where the todos can be editted.
+
+    'todo_filter' selects the todos shown after a refresh, and 'refresh' is
+    the auto-refresh interval in seconds (0 to refresh only on request).
+    """
     if not hcli:
         hcli = habitcli.HabitCLI()
     if not todos:
@@ -247,7 +669,17 @@ def make_gui(hcli=None, todos=None):
         todos = hcli.sort_nicely(todos)
 
     root = tk.Tk()
-    TodoFrame(root, hcli, todos).pack(side="top", fill="both", expand=True)
+    frame = TodoFrame(root, hcli, todos, todo_filter, refresh)
+    frame.pack(side="top", fill="both", expand=True)
+
+    def on_close():
+        """Warn before closing with saves still in flight."""
+        if not frame.table.pending or tkMessageBox.askyesno(
+                "Quit?", "%d saves are still pending. Quit anyway?" %
+                frame.table.pending):
+            root.destroy()
+
+    root.protocol("WM_DELETE_WINDOW", on_close)
     root.mainloop()
 
 if __name__ == '__main__':
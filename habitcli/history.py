@@ -0,0 +1,145 @@
+"""
+An append-only history of the user's stats.
+
+Each sample is a fixed-width record (timestamp, hp, mp, exp, gp, lvl). The
+raw samples go in one segment file, and downsampled tiers keep the last
+sample in each hour and each day, so long ranges can be read from a short
+tier. Files are memory-mapped and searched by timestamp, so a query only
+touches the records in its range.
+"""
+
+import bisect
+import mmap
+import os
+import re
+import struct
+import time
+
+from habitcli.utils import get_cache_filename
+
+
+RECORD = struct.Struct('<dffffI')
+
+# (suffix, bucket width in seconds); None is the raw tier
+TIERS = [('raw', None), ('1h', 3600), ('1d', 86400)]
+
+DURATION_UNITS = {'m': 60, 'h': 3600, 'd': 86400, 'w': 7 * 86400,
+                  'y': 365 * 86400}
+
+
+def parse_duration(duration):
+    """Parse a duration such as '90m', '12h', '30d' or '1y' into seconds."""
+    match = re.match(r'^\s*(\d+(?:\.\d+)?)\s*([mhdwy])\s*$', duration)
+    if not match:
+        raise ValueError("Duration '%s' unclear" % duration)
+    return float(match.group(1)) * DURATION_UNITS[match.group(2)]
+
+
+class _Timestamps(object):
+    """A sequence view of the timestamps in a mapped tier, for bisect."""
+    def __init__(self, data):
+        self.data = data
+
+    def __len__(self):
+        return len(self.data) // RECORD.size
+
+    def __getitem__(self, index):
+        return struct.unpack_from('<d', self.data, index * RECORD.size)[0]
+
+
+class StatsHistory(object):
+    """The stats history files of a profile, by default in the cache."""
+    def __init__(self, directory=None, profile=None):
+        self.filenames = {}
+        for suffix, _ in TIERS:
+            filename = get_cache_filename(".habit_stats.%s" % suffix, profile)
+            if directory:
+                filename = os.path.join(directory,
+                                        os.path.basename(filename))
+            self.filenames[suffix] = filename
+
+    def append(self, stats, timestamp=None):
+        """Record a sample of the given user stats."""
+        timestamp = timestamp if timestamp else time.time()
+        for suffix, width in TIERS:
+            sample_time = timestamp
+            if width:
+                sample_time = timestamp - timestamp % width
+            record = RECORD.pack(sample_time,
+                                 stats['hp'], stats['mp'],
+                                 stats['exp'], stats['gp'],
+                                 int(stats['lvl']))
+            self._append_record(self.filenames[suffix], record, sample_time)
+
+    @staticmethod
+    def _append_record(filename, record, sample_time):
+        """
+        Append a record, or replace the last one if it has the same time.
+        Samples older than the last record are dropped.
+        """
+        with open(filename, 'ab+') as tier_file:
+            tier_file.seek(0, os.SEEK_END)
+            size = tier_file.tell() - tier_file.tell() % RECORD.size
+            if size:
+                tier_file.seek(size - RECORD.size)
+                last_time = struct.unpack(
+                    '<d', tier_file.read(RECORD.size)[:8])[0]
+                if sample_time < last_time:
+                    return
+                if sample_time == last_time:
+                    # Append mode always writes at the end, so truncate
+                    tier_file.truncate(size - RECORD.size)
+            tier_file.write(record)
+
+    def query(self, start, end=None, max_points=None):
+        """
+        Return the (timestamp, hp, mp, exp, gp, lvl) samples between 'start'
+        and 'end', from the finest tier with at most 'max_points' of them.
+        """
+        end = end if end else time.time()
+        for suffix, _ in TIERS:
+            samples = self._query_tier(self.filenames[suffix], start, end,
+                                       max_points)
+            if samples is not None:
+                return samples
+        return self._query_tier(self.filenames[TIERS[-1][0]], start, end)
+
+    @staticmethod
+    def _query_tier(filename, start, end, max_points=None):
+        """
+        Read the samples of one tier within [start, end], or return None if
+        there are more than 'max_points' of them.
+        """
+        if not os.path.exists(filename) or \
+                os.path.getsize(filename) < RECORD.size:
+            return []
+        with open(filename, 'rb') as tier_file:
+            data = mmap.mmap(tier_file.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                timestamps = _Timestamps(data)
+                low = bisect.bisect_left(timestamps, start)
+                high = bisect.bisect_right(timestamps, end)
+                if max_points and high - low > max_points:
+                    return None
+                return [RECORD.unpack_from(data, index * RECORD.size)
+                        for index in range(low, high)]
+            finally:
+                data.close()
+
+
+def sparkline(values, width=60):
+    """Draw values as a single line of ASCII shading, 'width' columns wide."""
+    ramp = " .:-=+*#%@"
+    if not values:
+        return ""
+    # Average the values into at most 'width' columns
+    columns = []
+    for column in range(min(width, len(values))):
+        chunk = values[column * len(values) // min(width, len(values)):
+                       (column + 1) * len(values) // min(width, len(values))]
+        columns.append(float(sum(chunk)) / len(chunk))
+    low, high = min(columns), max(columns)
+    if high == low:
+        return ramp[len(ramp) // 2] * len(columns)
+    return "".join(ramp[int((value - low) / (high - low) * (len(ramp) - 1))]
+                   for value in columns)
@@ -0,0 +1,181 @@
+"""Bulk import of todos from NDJSON or CSV files."""
+
+import csv
+import hashlib
+import json
+import os
+import time
+from multiprocessing.pool import ThreadPool
+
+from habitcli.exceptions import NoSuchTagException
+from habitcli.utils import parse_datetime
+
+
+def read_records(filename):
+    """
+    Yield (line_number, record) pairs from an NDJSON or CSV file.
+
+    CSV files are recognized by their extension and must have a header row.
+    Recognized fields are 'text', 'tags', 'due', 'plan', 'notes' and
+    'checklist'; 'tags' and 'checklist' may be lists or, in CSV files,
+    strings separated by spaces and '|' respectively. An NDJSON line that is
+    not valid JSON yields its ValueError in place of the record.
+    """
+    with open(filename, 'rb') as infile:
+        if filename.lower().endswith('.csv'):
+            for index, row in enumerate(csv.DictReader(infile)):
+                record = dict((key, value.decode('utf-8'))
+                              for key, value in row.items()
+                              if key and value)
+                if 'checklist' in record:
+                    record['checklist'] = [item.strip() for item in
+                                           record['checklist'].split('|')
+                                           if item.strip()]
+                # Header is line 1
+                yield index + 2, record
+        else:
+            for index, line in enumerate(infile):
+                if line.strip():
+                    try:
+                        record = json.loads(line)
+                    except ValueError as err:
+                        record = err
+                    yield index + 1, record
+
+
+def record_key(line, record):
+    """A stable key identifying a record for checkpointing."""
+    digest = hashlib.sha1(json.dumps(record, sort_keys=True)).hexdigest()
+    return "%d:%s" % (line, digest[:12])
+
+
+class TodoImporter(object):
+    """
+    Create todos in bulk through a bounded worker pool.
+
+    Requests are paced by the API's shared limiter; 'rate', if given,
+    overrides its configured requests per second.
+    """
+    def __init__(self, hcli, workers=4, rate=None, checkpoint_filename=None):
+        self.hcli = hcli
+        self.workers = workers
+        if rate:
+            hcli.api.limiter.set_rate(rate)
+        self.checkpoint_filename = checkpoint_filename
+        self._date_cache = {}
+
+    def _parse_date(self, date_string):
+        """Parse a natural language date, caching repeated strings."""
+        if date_string not in self._date_cache:
+            self._date_cache[date_string] = parse_datetime(date_string)
+        return self._date_cache[date_string]
+
+    def load_checkpoint(self):
+        """Return the set of record keys already imported."""
+        if not self.checkpoint_filename or \
+                not os.path.exists(self.checkpoint_filename):
+            return set()
+        with open(self.checkpoint_filename, 'r') as checkpoint:
+            return set(line.strip() for line in checkpoint if line.strip())
+
+    def build_todo(self, record):
+        """Build an unsaved Todo from an import record."""
+        from habitcli import Todo
+
+        reverse_tag_dict = self.hcli.get_user()['reverse_tag_dict']
+        new_todo = Todo(text=record['text'], hcli=self.hcli)
+
+        tags = record.get('tags', [])
+        if isinstance(tags, basestring):
+            tags = tags.replace(',', ' ').split()
+        for tag in tags:
+            tag = tag.replace("+", "")
+            if tag not in reverse_tag_dict.keys():
+                raise NoSuchTagException(tag, reverse_tag_dict.keys())
+            new_todo['tags'][reverse_tag_dict[tag]] = True
+
+        if record.get('notes'):
+            new_todo['notes'] = record['notes']
+        if record.get('due'):
+            new_todo.set_due_date(self._parse_date(record['due']))
+        # The planning date lives in the notes, so it wins over plain notes
+        if record.get('plan'):
+            new_todo.set_planning_date(self._parse_date(record['plan']))
+        if record.get('checklist'):
+            new_todo['checklist'] = [{'text': item, 'completed': False}
+                                     for item in record['checklist']]
+        return new_todo
+
+    def _create(self, job):
+        """Worker: create one todo, returning (key, line, error)."""
+        key, line, todo = job
+        try:
+            # pyhabit hands back the error body of a rejected request as if
+            # it were the new todo, while the concurrent client raises
+            # HabitAPIError for it
+            todo.create_async().get()
+        except Exception as err:  # pylint: disable=broad-except
+            return key, line, str(err) or err.__class__.__name__
+        return key, line, None
+
+    def run(self, records):
+        """
+        Import the (line_number, record) pairs and return a summary dict with
+        the keys 'created', 'skipped', 'failed' and 'elapsed'.
+        """
+        start = time.time()
+        done = self.load_checkpoint()
+        summary = {'created': 0, 'skipped': 0, 'failed': [], 'elapsed': 0.0}
+
+        jobs = []
+        for line, record in records:
+            if isinstance(record, ValueError):
+                summary['failed'].append((line, "Invalid JSON: %s" % record))
+                continue
+            key = record_key(line, record)
+            if key in done:
+                summary['skipped'] += 1
+                continue
+            try:
+                jobs.append((key, line, self.build_todo(record)))
+            except Exception as err:  # pylint: disable=broad-except
+                summary['failed'].append((line, str(err)))
+
+        # Build the concurrent client before the workers share it
+        self.hcli.get_async_api()
+        checkpoint = None
+        if self.checkpoint_filename:
+            checkpoint = open(self.checkpoint_filename, 'a')
+
+        pool = ThreadPool(self.workers)
+        try:
+            for key, line, error in pool.imap_unordered(self._create, jobs):
+                if error:
+                    summary['failed'].append((line, error))
+                    continue
+                summary['created'] += 1
+                if checkpoint:
+                    checkpoint.write(key + "\n")
+                    checkpoint.flush()
+        finally:
+            pool.close()
+            pool.join()
+            if checkpoint:
+                checkpoint.close()
+
+        summary['failed'].sort()
+        summary['elapsed'] = time.time() - start
+        return summary
+
+
+def format_summary(summary):
+    """Format an import summary as a short report."""
+    lines = ["Created: %d" % summary['created'],
+             "Skipped (already imported): %d" % summary['skipped'],
+             "Failed: %d" % len(summary['failed'])]
+    for line, error in summary['failed']:
+        lines.append("    line %d: %s" % (line, error))
+    if summary['created'] and summary['elapsed']:
+        lines.append("%.1f todos/sec" %
+                     (summary['created'] / summary['elapsed']))
+    return "\n".join(lines)
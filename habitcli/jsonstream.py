@@ -0,0 +1,180 @@
+"""
+Incremental parsing of a JSON object with top-level field projection.
+
+Only the requested top-level fields are decoded. Everything else is scanned
+past without being decoded or even held in memory, so parsing cost and
+peak memory track the fields that are used, not the whole document.
+"""
+
+import json
+import re
+
+
+# Characters that can change the scanner state outside and inside strings
+_STRUCTURE = re.compile(r'["{}\[\],]')
+_STRING = re.compile(r'["\\]')
+_SPACE = re.compile(r'\s*')
+
+
+class _ValueScanner(object):
+    """Finds the end of one JSON value, fed a piece at a time."""
+    def __init__(self):
+        self.depth = 0
+        self.in_string = False
+        self.escaped = False
+
+    def feed(self, text, pos):
+        """
+        Scan text from pos. Returns the index just past the end of the
+        value, or None if the value continues beyond the end of text.
+        """
+        while True:
+            if self.escaped:
+                if pos >= len(text):
+                    return None
+                self.escaped = False
+                pos += 1
+            if self.in_string:
+                match = _STRING.search(text, pos)
+                if not match:
+                    return None
+                pos = match.end()
+                if match.group() == '\\':
+                    self.escaped = True
+                    continue
+                self.in_string = False
+                if self.depth == 0:
+                    return pos
+            else:
+                match = _STRUCTURE.search(text, pos)
+                if not match:
+                    return None
+                char = match.group()
+                if char in ',}]' and self.depth == 0:
+                    # The end of a bare number, literal or empty value
+                    return match.start()
+                pos = match.end()
+                if char == '"':
+                    self.in_string = True
+                elif char in '{[':
+                    self.depth += 1
+                elif char in '}]':
+                    self.depth -= 1
+                    if self.depth == 0:
+                        return pos
+
+
+class _Reader(object):
+    """A buffer over an iterator of text chunks."""
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.buf = ''
+        self.pos = 0
+
+    def more(self):
+        """Append the next non-empty chunk; False at the end of input."""
+        for chunk in self.chunks:
+            if chunk:
+                self.buf += chunk
+                return True
+        return False
+
+    def compact(self):
+        """Drop the consumed part of the buffer."""
+        self.buf = self.buf[self.pos:]
+        self.pos = 0
+
+    def next_char(self):
+        """Skip whitespace and consume the next character."""
+        while True:
+            self.pos = _SPACE.match(self.buf, self.pos).end()
+            if self.pos < len(self.buf):
+                self.pos += 1
+                return self.buf[self.pos - 1]
+            self.compact()
+            if not self.more():
+                raise ValueError("Unexpected end of JSON input")
+
+    def skip_space(self):
+        """Skip whitespace, reading more input if necessary."""
+        while True:
+            self.pos = _SPACE.match(self.buf, self.pos).end()
+            if self.pos < len(self.buf) or not self.more():
+                return
+
+    def decode_value(self, decoder):
+        """
+        Decode one value straight from the buffer, reading more input until
+        the value is complete.
+        """
+        while True:
+            try:
+                value, end = decoder.raw_decode(self.buf, self.pos)
+            except ValueError:
+                value, end = None, None
+            # A value ending with the buffer may be a truncated number
+            if end is not None and end < len(self.buf):
+                self.pos = end
+                return value
+            # Read at least as much again, so a large value is decoded only
+            # a few times
+            self.compact()
+            size = len(self.buf)
+            while len(self.buf) < 2 * size + 1 and self.more():
+                pass
+            if len(self.buf) == size:
+                if end is None:
+                    raise ValueError("Unexpected end of JSON input")
+                self.pos = end
+                return value
+
+    def skip_value(self):
+        """
+        Consume one value without decoding it, discarding it from the
+        buffer as it is scanned.
+        """
+        scanner = _ValueScanner()
+        while True:
+            end = scanner.feed(self.buf, self.pos)
+            if end is not None:
+                self.pos = end
+                return
+            self.buf, self.pos = '', 0
+            if not self.more():
+                if scanner.depth == 0 and not scanner.in_string:
+                    return
+                raise ValueError("Unexpected end of JSON input")
+
+
+def project(chunks, fields):
+    """
+    Parse a JSON object from an iterable of text chunks, returning a dict of
+    only the top-level keys in 'fields'.
+    """
+    fields = set(fields)
+    decoder = json.JSONDecoder()
+    reader = _Reader(chunks)
+    if reader.next_char() != '{':
+        raise ValueError("Expected a JSON object")
+
+    result = {}
+    while True:
+        char = reader.next_char()
+        if char == '}':
+            return result
+        if char == ',':
+            continue
+        if char != '"':
+            raise ValueError("Expected an object key")
+
+        reader.pos -= 1
+        key = reader.decode_value(decoder)
+        if reader.next_char() != ':':
+            raise ValueError("Expected ':' after key %r" % key)
+        reader.skip_space()
+
+        if key in fields:
+            result[key] = reader.decode_value(decoder)
+        else:
+            reader.skip_value()
+        reader.compact()
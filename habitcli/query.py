@@ -0,0 +1,336 @@
+"""
+A small query language for selecting todos.
+
+A query is a list of terms, all of which must match, except that a run of
+consecutive tag words matches any of those tags:
+
+    +work, work         has the tag 'work'
+    -urgent, not:urgent does not have the tag 'urgent'
+    due<friday          due before a natural language date (also >, <=, >=)
+    plan>=tomorrow      planned on or after a date
+    due:overdue         due in the past (also plan:overdue)
+    plan:none           not planned (also due:none, plan:any, due:any)
+    text~deploy         text contains 'deploy', ignoring case
+    checklist:incomplete  has unchecked checklist items (also 'complete',
+                        'none' and 'any')
+
+A date without a time stands for its whole day, so due<friday excludes
+all of Friday and due<=friday includes it.
+
+Terms are compiled into predicates. Tag and date terms can also be answered
+from a TodoIndex (tag postings lists and sorted date arrays), and the most
+selective of those is used to pick the candidates before the remaining
+predicates are checked, cheapest first.
+"""
+
+import bisect
+import calendar
+import re
+import time
+
+from habitcli.utils import parse_date_range
+
+
+# Sorts after any todo ID, to bisect past every entry with a given date
+LAST_ID = u'\uffff'
+
+
+def to_timestamp(datetimeobj):
+    """Convert a datetime, aware or naive (local), to a UNIX timestamp."""
+    if datetimeobj.tzinfo:
+        return calendar.timegm(datetimeobj.utctimetuple())
+    return time.mktime(datetimeobj.timetuple())
+
+
+class TodoIndex(object):
+    """
+    Secondary indexes over a list of todos, keyed by todo ID.
+
+    Holds only plain data, so it can be pickled into the snapshot.
+    """
+    def __init__(self, todos):
+        self.ids = set()
+        self.tags = {}
+        self.dates = {'plan': [], 'due': []}
+        self.undated = {'plan': set(), 'due': set()}
+        for todo in todos:
+            self.add(todo)
+        for key in self.dates:
+            self.dates[key].sort()
+
+    def add(self, todo):
+        """Add one todo. The date arrays must be re-sorted afterwards."""
+        todo_id = todo['id']
+        self.ids.add(todo_id)
+        for tag_id, applied in todo['tags'].items():
+            if applied:
+                self.tags.setdefault(tag_id, set()).add(todo_id)
+        for key, value in [('plan', todo.get_planning_date()),
+                           ('due', todo.get_due_date())]:
+            if value:
+                self.dates[key].append((to_timestamp(value), todo_id))
+            else:
+                self.undated[key].add(todo_id)
+
+    def date_range(self, key, low=None, high=None, inclusive=True):
+        """Return the IDs whose 'plan' or 'due' date lies within the range."""
+        dates = self.dates[key]
+        start = 0
+        end = len(dates)
+        if low is not None:
+            if inclusive:
+                start = bisect.bisect_left(dates, (low,))
+            else:
+                start = bisect.bisect_left(dates, (low, LAST_ID))
+        if high is not None:
+            if inclusive:
+                end = bisect.bisect_left(dates, (high, LAST_ID))
+            else:
+                end = bisect.bisect_left(dates, (high,))
+        return set(todo_id for _, todo_id in dates[start:end])
+
+    def date_entries(self, key, low, high):
+        """
+        Return the (timestamp, ID) entries of 'plan' or 'due' dates in
+        [low, high), in date order.
+        """
+        dates = self.dates[key]
+        return dates[bisect.bisect_left(dates, (low,)):
+                     bisect.bisect_left(dates, (high,))]
+
+    def date_counts(self, key, boundaries):
+        """
+        Count the 'plan' or 'due' dates between each pair of consecutive
+        timestamps in 'boundaries', without touching the entries.
+        """
+        dates = self.dates[key]
+        positions = [bisect.bisect_left(dates, (boundary,))
+                     for boundary in boundaries]
+        return [end - start for start, end in zip(positions, positions[1:])]
+
+    def date_range_size(self, key, low=None, high=None):
+        """Estimate the size of date_range() without building it."""
+        dates = self.dates[key]
+        start = bisect.bisect_left(dates, (low,)) if low is not None else 0
+        end = bisect.bisect_left(dates, (high, LAST_ID)) \
+            if high is not None else len(dates)
+        return max(0, end - start)
+
+
+class Term(object):
+    """
+    One compiled query term.
+
+    'cost' is the relative price of match(). lookup(index) returns the set
+    of matching IDs if the term can be answered from the index, else None;
+    estimate(index) returns the size of that set.
+    """
+    cost = 1
+
+    def match(self, todo):
+        """Return True if the todo satisfies the term."""
+        raise NotImplementedError
+
+    def lookup(self, index):
+        """Return the matching IDs from the index, or None."""
+        return None
+
+    def estimate(self, index):
+        """Estimate how many todos lookup() would return."""
+        return None
+
+
+class TagTerm(Term):
+    """The todo has (or, negated, lacks) any of the given tag IDs."""
+    def __init__(self, tag_ids, negate=False):
+        self.tag_ids = set(tag_ids)
+        self.negate = negate
+
+    def match(self, todo):
+        applied = set(tag_id for tag_id, value in todo['tags'].items()
+                      if value)
+        return bool(applied & self.tag_ids) != self.negate
+
+    def lookup(self, index):
+        if self.negate:
+            return None
+        found = set()
+        for tag_id in self.tag_ids:
+            found |= index.tags.get(tag_id, set())
+        return found
+
+    def estimate(self, index):
+        if self.negate:
+            return None
+        return sum(len(index.tags.get(tag_id, ())) for tag_id in self.tag_ids)
+
+
+class DateTerm(Term):
+    """The todo's plan or due date compares with a date, or is (un)set."""
+    cost = 2
+
+    def __init__(self, key, operator, value=None):
+        self.key = key
+        self.operator = operator
+        self.value = value
+
+    def _date(self, todo):
+        """The date this term looks at, as a timestamp or None."""
+        if self.key == 'plan':
+            value = todo.get_planning_date()
+        else:
+            value = todo.get_due_date()
+        return to_timestamp(value) if value else None
+
+    def match(self, todo):
+        date = self._date(todo)
+        if self.operator == 'none':
+            return date is None
+        if date is None:
+            return False
+        if self.operator == 'any':
+            return True
+        return {'<': date < self.value,
+                '<=': date <= self.value,
+                '>': date > self.value,
+                '>=': date >= self.value}[self.operator]
+
+    def _bounds(self):
+        """The (low, high, inclusive) range of the comparison."""
+        if self.operator in ('<', '<='):
+            return None, self.value, self.operator == '<='
+        if self.operator in ('>', '>='):
+            return self.value, None, self.operator == '>='
+        return None, None, True
+
+    def lookup(self, index):
+        if self.operator == 'none':
+            return set(index.undated[self.key])
+        low, high, inclusive = self._bounds()
+        return index.date_range(self.key, low, high, inclusive)
+
+    def estimate(self, index):
+        if self.operator == 'none':
+            return len(index.undated[self.key])
+        low, high, _ = self._bounds()
+        return index.date_range_size(self.key, low, high)
+
+
+class TextTerm(Term):
+    """The todo's text contains a string, ignoring case."""
+    cost = 3
+
+    def __init__(self, text):
+        self.text = text.lower()
+
+    def match(self, todo):
+        return self.text in todo['text'].lower()
+
+
+class ChecklistTerm(Term):
+    """The todo's checklist state."""
+    cost = 2
+
+    def __init__(self, state):
+        self.state = state
+
+    def match(self, todo):
+        items = todo.get('checklist', [])
+        if self.state == 'none':
+            return not items
+        if self.state == 'any':
+            return bool(items)
+        incomplete = [item for item in items if not item.get('completed')]
+        if self.state == 'incomplete':
+            return bool(incomplete)
+        return bool(items) and not incomplete
+
+
+TERM_RE = re.compile(r'^(plan|due)(<=|>=|<|>|:)(.+)$')
+
+
+def compile_term(term, tag_ids_for):
+    """
+    Compile one query term. 'tag_ids_for' maps a tag name to a list of tag
+    IDs. Raises ValueError for a term that cannot be understood, including
+    a tag that does not exist.
+    """
+    match = TERM_RE.match(term)
+    if match:
+        key, operator, value = match.groups()
+        if operator == ':':
+            if value == 'overdue':
+                return DateTerm(key, '<', time.time())
+            if value in ('none', 'any'):
+                return DateTerm(key, value)
+            raise ValueError("Unknown %s state '%s'" % (key, value))
+        start, end = parse_date_range(value.strip('"\''))
+        if end is None:
+            return DateTerm(key, operator, to_timestamp(start))
+        # A bare date covers its whole day, so "before" means before its
+        # start and "after" means from the start of the next day
+        if operator in ('<', '>='):
+            return DateTerm(key, operator, to_timestamp(start))
+        return DateTerm(key, '<' if operator == '<=' else '>=',
+                        to_timestamp(end))
+    if term.startswith('text~'):
+        return TextTerm(term[len('text~'):].strip('"\''))
+    if term.startswith('checklist:'):
+        state = term[len('checklist:'):]
+        if state not in ('incomplete', 'complete', 'none', 'any'):
+            raise ValueError("Unknown checklist state '%s'" % state)
+        return ChecklistTerm(state)
+    negate = term.startswith('-') or term.startswith('not:')
+    if negate:
+        term = term[1:] if term.startswith('-') else term[len('not:'):]
+    name = term.lstrip('+')
+    tag_ids = tag_ids_for(name)
+    if not tag_ids:
+        raise ValueError("Unknown tag '%s'" % name)
+    return TagTerm(tag_ids, negate=negate)
+
+
+def compile_query(terms, tag_ids_for):
+    """
+    Compile a list of query terms, merging each run of tag words into one
+    term that matches any of their tags.
+    """
+    compiled = []
+    for term in terms:
+        term = compile_term(term, tag_ids_for)
+        if (isinstance(term, TagTerm) and not term.negate and compiled and
+                isinstance(compiled[-1], TagTerm) and
+                not compiled[-1].negate):
+            compiled[-1].tag_ids |= term.tag_ids
+        else:
+            compiled.append(term)
+    return compiled
+
+
+def run_query(compiled, todos, index=None):
+    """
+    Return the todos matching every compiled term, in their original order.
+
+    If an index covering 'todos' is given, the indexable term with the
+    smallest estimated result picks the candidates, other indexed terms are
+    intersected in while that stays cheaper than checking them one by one,
+    and the rest are checked on the candidates in order of cost.
+    """
+    remaining = list(compiled)
+    candidates = None
+    if index is not None:
+        indexed = sorted([(term.estimate(index), term) for term in remaining
+                          if term.estimate(index) is not None],
+                         key=lambda pair: pair[0])
+        for size, term in indexed:
+            if candidates is not None and size > len(candidates):
+                break
+            found = term.lookup(index)
+            candidates = found if candidates is None else candidates & found
+            remaining.remove(term)
+
+    if candidates is not None:
+        todos = [todo for todo in todos if todo['id'] in candidates]
+    remaining.sort(key=lambda term: term.cost)
+    return [todo for todo in todos
+            if all(term.match(todo) for term in remaining)]
@@ -0,0 +1,198 @@
+"""Client-side rate limiting for calls to the HabitRPG API."""
+
+import email.utils
+import random
+import threading
+import time
+
+from pyhabit import HabitAPI
+from requests import ConnectionError, Timeout
+
+from habitcli.jsonstream import project
+
+
+IDEMPOTENT_METHODS = ('get', 'head', 'put', 'delete')
+
+STREAM_CHUNK_SIZE = 64 * 1024
+
+# Seconds to wait for a response before giving up on a request
+DEFAULT_TIMEOUT = 30.0
+
+
+class TokenBucket(object):
+    """
+    A thread-safe token bucket.
+
+    Tokens are added at 'rate' per second up to 'capacity'; each call to
+    acquire() removes one token, sleeping until one is available.
+    """
+    def __init__(self, rate, capacity=None):
+        self.rate = float(rate)
+        self.capacity = float(capacity if capacity else max(rate, 1))
+        self.tokens = self.capacity
+        self.last = time.time()
+        self.lock = threading.Lock()
+
+    def _refill(self):
+        """Add the tokens accumulated since the last refill."""
+        now = time.time()
+        self.tokens = min(self.capacity,
+                          self.tokens + (now - self.last) * self.rate)
+        self.last = now
+
+    def acquire(self):
+        """Block until a token is available, then consume it."""
+        while True:
+            with self.lock:
+                self._refill()
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class AdaptiveLimiter(object):
+    """
+    A shared limiter combining a token bucket with AIMD concurrency control.
+
+    At most int(limit) requests may be in flight at once. Each successful
+    request raises the limit additively (by roughly one per window of
+    requests), each throttled request halves it, and a Retry-After hint
+    pauses all new requests until it has elapsed.
+    """
+    def __init__(self, rate=5.0, max_concurrency=8):
+        self.bucket = TokenBucket(rate)
+        self.max_concurrency = max_concurrency
+        self.limit = float(max_concurrency)
+        self.in_flight = 0
+        self.paused_until = 0.0
+        self.condition = threading.Condition()
+
+    def set_rate(self, rate):
+        """Change the sustained request rate."""
+        self.bucket = TokenBucket(rate)
+
+    def acquire(self):
+        """Block until a request may be sent."""
+        with self.condition:
+            while True:
+                pause = self.paused_until - time.time()
+                if pause > 0:
+                    self.condition.wait(pause)
+                elif self.in_flight >= int(self.limit):
+                    self.condition.wait()
+                else:
+                    self.in_flight += 1
+                    break
+        self.bucket.acquire()
+
+    def release(self, throttled=False, retry_after=None):
+        """Record the outcome of a request sent after acquire()."""
+        with self.condition:
+            self.in_flight -= 1
+            if throttled:
+                self.limit = max(1.0, self.limit / 2)
+                if retry_after:
+                    self.paused_until = max(self.paused_until,
+                                            time.time() + retry_after)
+            else:
+                self.limit = min(float(self.max_concurrency),
+                                 self.limit + 1.0 / self.limit)
+            self.condition.notify_all()
+
+
+def parse_retry_after(value):
+    """Return the number of seconds requested by a Retry-After header."""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        parsed = email.utils.parsedate_tz(value)
+        if parsed:
+            return max(0.0, email.utils.mktime_tz(parsed) - time.time())
+    return None
+
+
+def backoff_delay(attempt, base=0.5, cap=30.0):
+    """Full-jitter exponential backoff for the given retry attempt."""
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+def send_with_retries(limiter, send, method, max_retries=2):
+    """
+    Call send() to perform one HTTP request through the limiter.
+
+    Throttled (429) requests are always retried, since the server did not
+    act on them. Server errors and connection errors are only retried for
+    idempotent methods, with jittered exponential backoff. A request that
+    times out fails as a ConnectionError.
+    """
+    idempotent = method.lower() in IDEMPOTENT_METHODS
+    attempt = 0
+    while True:
+        limiter.acquire()
+        try:
+            response = send()
+        except (ConnectionError, Timeout) as err:
+            limiter.release(throttled=True)
+            if not idempotent or attempt >= max_retries:
+                if isinstance(err, ConnectionError):
+                    raise
+                raise ConnectionError(err)
+            time.sleep(backoff_delay(attempt))
+            attempt += 1
+            continue
+        except Exception:
+            # Free the slot whatever went wrong, or it is lost for good
+            limiter.release()
+            raise
+
+        status = response.status_code
+        if status != 429 and status < 500:
+            limiter.release()
+            return response
+
+        retry_after = parse_retry_after(response.headers.get('Retry-After'))
+        limiter.release(throttled=True, retry_after=retry_after)
+        if attempt >= max_retries or not (status == 429 or idempotent):
+            return response
+        time.sleep(max(retry_after or 0, backoff_delay(attempt)))
+        attempt += 1
+
+
+class ThrottledHabitAPI(HabitAPI):
+    """
+    A HabitAPI whose requests all go through send_with_retries(), and time
+    out after 'timeout' seconds without a response.
+    """
+    def __init__(self, user_id, api_key, limiter=None, max_retries=2,
+                 timeout=DEFAULT_TIMEOUT, **kwargs):
+        HabitAPI.__init__(self, user_id, api_key, **kwargs)
+        self.limiter = limiter if limiter else AdaptiveLimiter()
+        self.max_retries = max_retries
+        self.timeout = timeout
+
+    def send(self, method, path, *args, **kwargs):
+        """Send one request, with no retries."""
+        kwargs.setdefault('timeout', self.timeout)
+        return HabitAPI.request(self, method, path, *args, **kwargs)
+
+    def request(self, method, path, *args, **kwargs):
+        """Send a request, retrying throttled and failed calls."""
+        send = lambda: self.send(method, path, *args, **kwargs)
+        return send_with_retries(self.limiter, send, method,
+                                 self.max_retries)
+
+    def user(self, fields=None):
+        """
+        Fetch the user, decoding only the given top-level fields if any.
+
+        With 'fields', the response is streamed through a projecting parser,
+        so the unused parts of the document are never decoded.
+        """
+        if not fields:
+            return HabitAPI.user(self)
+        response = self.request("get", "user", stream=True)
+        return project(response.iter_content(STREAM_CHUNK_SIZE), fields)
@@ -0,0 +1,102 @@
+"""
+Reminders for plan and due dates, kept in a timer heap.
+
+The reminder loop sleeps until the earliest deadline, so nothing runs
+between deadlines. When todos change, only the changed ones are pushed
+again under a new generation number; their old heap entries are left in
+place and skipped when they come up, because their generation is no longer
+the todo's current one.
+"""
+
+import heapq
+import os
+import subprocess
+import sys
+
+from habitcli.query import to_timestamp
+
+
+class ReminderQueue(object):
+    """A min-heap of upcoming plan and due date reminders."""
+    def __init__(self, lead=0):
+        self.lead = lead
+        self.heap = []
+        # todo ID -> (plan timestamp, due timestamp, text)
+        self.entries = {}
+        # todo ID -> generation of its current heap items
+        self.generations = {}
+        self.generation = 0
+
+    @staticmethod
+    def _entry(todo):
+        """The reminder-relevant state of a todo."""
+        plan_date = todo.get_planning_date()
+        due_date = todo.get_due_date()
+        return (to_timestamp(plan_date) if plan_date else None,
+                to_timestamp(due_date) if due_date else None,
+                todo['text'])
+
+    def sync(self, todos, now):
+        """
+        Update the reminders from the incomplete todos, scheduling those
+        that are new or changed. Returns the number of todos that changed.
+        """
+        current = dict((todo['id'], todo) for todo in todos
+                       if not todo.get('completed'))
+        changed = 0
+        for todo_id, todo in current.items():
+            entry = self._entry(todo)
+            if self.entries.get(todo_id) == entry:
+                continue
+            self.entries[todo_id] = entry
+            self.generation += 1
+            self.generations[todo_id] = self.generation
+            changed += 1
+            for kind, when in [('plan', entry[0]), ('due', entry[1])]:
+                if when is not None and when - self.lead > now:
+                    heapq.heappush(self.heap, (when - self.lead,
+                                               self.generation, todo_id,
+                                               kind, entry))
+        for todo_id in set(self.entries) - set(current):
+            del self.entries[todo_id]
+            del self.generations[todo_id]
+            changed += 1
+        return changed
+
+    def _is_stale(self, item):
+        """True if a heap item was superseded by a later sync."""
+        return self.generations.get(item[2]) != item[1]
+
+    def next_time(self):
+        """Return the time of the next reminder, or None."""
+        while self.heap and self._is_stale(self.heap[0]):
+            heapq.heappop(self.heap)
+        return self.heap[0][0] if self.heap else None
+
+    def pop_due(self, now):
+        """Pop the reminders due by 'now' as (kind, todo ID, text, date)."""
+        reminders = []
+        while self.heap and self.heap[0][0] <= now:
+            item = heapq.heappop(self.heap)
+            if not self._is_stale(item):
+                when, _, todo_id, kind, entry = item
+                reminders.append((kind, todo_id, entry[2], when + self.lead))
+        return reminders
+
+
+def notify(reminder, command=None):
+    """
+    Deliver a reminder by running a shell command with the reminder in its
+    environment, or else by printing it and ringing the terminal bell.
+    """
+    kind, todo_id, text, _ = reminder
+    if command:
+        env = dict(os.environ,
+                   HABIT_REMINDER=kind,
+                   HABIT_TODO_ID=todo_id.encode('utf-8'),
+                   HABIT_TODO_TEXT=text.encode('utf-8'))
+        subprocess.call(command, shell=True, env=env)
+    else:
+        label = "Planned" if kind == 'plan' else "Due"
+        sys.stdout.write(("\a%s: %s\n" % (label, text)).encode('utf-8'))
+        sys.stdout.flush()
@@ -0,0 +1,153 @@
+"""
+Ranked full-text search over todos.
+
+An inverted index of the words in each todo's text, notes and checklist is
+kept in the cache and updated on sync: only todos whose content hash has
+changed are re-tokenized. Queries are ranked with BM25 and only touch the
+postings of their own words.
+"""
+
+import hashlib
+import math
+import re
+
+from habitcli.utils import deserialize_date
+from habitcli.utils import load_search_index, save_search_index
+
+
+WORD_RE = re.compile(r'\w+', re.UNICODE)
+
+# BM25 parameters
+K1 = 1.2
+B = 0.75
+
+
+def tokenize(text):
+    """Split text into lower case words."""
+    return WORD_RE.findall(text.lower())
+
+
+def todo_content(todo):
+    """
+    Return the searchable text of a todo. Notes holding only a serialized
+    planning date are left out.
+    """
+    parts = [todo.get('text', '')]
+    notes = todo.get('notes', '')
+    if notes and not deserialize_date(notes):
+        parts.append(notes)
+    parts.extend(item.get('text', '') for item in todo.get('checklist', []))
+    return u"\n".join(parts)
+
+
+def content_hash(todo):
+    """Hash the fields of a todo that are indexed."""
+    raw = [todo.get('text', ''), todo.get('notes', '')]
+    raw.extend(item.get('text', '') for item in todo.get('checklist', []))
+    return hashlib.sha1(u"\0".join(raw).encode('utf-8')).hexdigest()
+
+
+class SearchIndex(object):
+    """An inverted index of todo words, with BM25 ranking."""
+    def __init__(self):
+        # word -> {todo ID: term frequency}
+        self.postings = {}
+        # todo ID -> (content hash, document length, text, completed)
+        self.docs = {}
+        # todo ID -> distinct words, to remove a todo's postings
+        self.doc_words = {}
+        self.total_length = 0
+
+    def add(self, todo):
+        """Index a todo that is not yet in the index."""
+        todo_id = todo['id']
+        words = tokenize(todo_content(todo))
+        counts = {}
+        for word in words:
+            counts[word] = counts.get(word, 0) + 1
+        for word, count in counts.items():
+            self.postings.setdefault(word, {})[todo_id] = count
+        self.docs[todo_id] = (content_hash(todo), len(words),
+                              todo.get('text', ''),
+                              bool(todo.get('completed')))
+        self.doc_words[todo_id] = list(counts)
+        self.total_length += len(words)
+
+    def remove(self, todo_id):
+        """Remove a todo from the index."""
+        for word in self.doc_words.pop(todo_id):
+            postings = self.postings[word]
+            del postings[todo_id]
+            if not postings:
+                del self.postings[word]
+        self.total_length -= self.docs.pop(todo_id)[1]
+
+    def sync(self, todos, unchanged=None):
+        """
+        Bring the index in line with the given todos, re-indexing only the
+        ones that were added or changed. The IDs in 'unchanged' are kept as
+        they are. Returns True if anything changed.
+        """
+        changed = False
+        seen = set(unchanged if unchanged else [])
+        for todo in todos:
+            todo_id = todo['id']
+            seen.add(todo_id)
+            doc = self.docs.get(todo_id)
+            if doc and doc[0] == content_hash(todo):
+                if doc[3] != bool(todo.get('completed')):
+                    self.docs[todo_id] = doc[:3] + (not doc[3],)
+                    changed = True
+                continue
+            if doc:
+                self.remove(todo_id)
+            self.add(todo)
+            changed = True
+        for todo_id in set(self.docs) - seen:
+            self.remove(todo_id)
+            changed = True
+        return changed
+
+    def search(self, query, limit=10):
+        """
+        Rank the todos matching any word of the query.
+
+        Returns up to 'limit' (score, todo ID, text, completed) tuples, best
+        first.
+        """
+        if not self.docs:
+            return []
+        num_docs = len(self.docs)
+        avg_length = float(self.total_length) / num_docs or 1.0
+        scores = {}
+        for word in set(tokenize(query)):
+            postings = self.postings.get(word, {})
+            if not postings:
+                continue
+            idf = math.log(1 + (num_docs - len(postings) + 0.5) /
+                           (len(postings) + 0.5))
+            for todo_id, count in postings.items():
+                length = self.docs[todo_id][1]
+                norm = K1 * (1 - B + B * length / avg_length)
+                scores[todo_id] = scores.get(todo_id, 0.0) + \
+                    idf * count * (K1 + 1) / (count + norm)
+        ranked = sorted(scores.items(), key=lambda item: -item[1])[:limit]
+        return [(score, todo_id) + self.docs[todo_id][2:]
+                for todo_id, score in ranked]
+
+
+def get_search_index(profile=None):
+    """Load the search index of a profile, or an empty one."""
+    index = load_search_index(profile)
+    return index if index is not None else SearchIndex()
+
+
+def update_search_index(todos, profile=None, unchanged=None):
+    """
+    Sync the stored search index with the active and archived todos, or
+    with the given todos and the 'unchanged' IDs.
+    """
+    index = get_search_index(profile)
+    if index.sync(todos, unchanged):
+        save_search_index(index, profile)
+    return index
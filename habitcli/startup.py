@@ -0,0 +1,60 @@
+"""
+Fetching the user in the background during startup.
+
+The network fetch runs in a daemon thread while the cache is loaded, and
+the caller waits for it only up to a deadline. A fetch that finishes after
+the caller gave up on it still hands its result on, so that it can refresh
+the cache if the process is still running.
+"""
+
+import threading
+
+
+class BackgroundFetch(object):
+    """Runs a fetch function in a daemon thread."""
+    def __init__(self, fetch, on_late=None):
+        self.fetch = fetch
+        self.on_late = on_late
+        self.result = None
+        self.error = None
+        self.abandoned = False
+        self.done = threading.Event()
+        self.lock = threading.Lock()
+        thread = threading.Thread(target=self._run)
+        thread.daemon = True
+        thread.start()
+
+    def _run(self):
+        """Run the fetch and keep its result or error."""
+        try:
+            result, error = self.fetch(), None
+        except Exception as err:  # pylint: disable=broad-except
+            result, error = None, err
+        with self.lock:
+            self.result, self.error = result, error
+            self.done.set()
+            late = self.abandoned
+        if late and error is None and self.on_late:
+            self.on_late(result)
+
+    def wait(self, timeout=None):
+        """
+        Wait for the fetch, for at most 'timeout' seconds if given. Returns
+        True if it finished; otherwise the fetch is abandoned to on_late.
+        """
+        if timeout is None:
+            # Wait in slices so that Ctrl-C still gets through
+            while not self.done.wait(1.0):
+                pass
+        else:
+            self.done.wait(timeout)
+        with self.lock:
+            if not self.done.is_set():
+                self.abandoned = True
+            return self.done.is_set()
+
+    def get(self):
+        """Return the result of a finished fetch, or raise its error."""
+        if self.error is not None:
+            raise self.error
+        return self.result
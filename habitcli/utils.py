@@ -3,9 +3,12 @@
 import ConfigParser
 import datetime
 import dateutil.parser
+import hashlib
+import json
 import os
-import pickle
+import cPickle as pickle
 import pytz
+import re
 import yaml
 
 from parsedatetime import Calendar
@@ -14,7 +17,13 @@ from tzlocal import get_localzone
 from habitcli.exceptions import DateParseException, DateFormatException
 
 
-CACHE_DIR = os.path.dirname(os.path.realpath(__file__))
+CACHE_DIR = os.environ.get('HABIT_CACHE_DIR',
+                           os.path.dirname(os.path.realpath(__file__)))
+
+# A datetime as serialize_date writes it, e.g. "2014-01-02 03:04:05\n...\n"
+SERIALIZED_DATE_RE = re.compile(
+    r'\s*\d{4}-\d\d?-\d\d?([Tt]|\s+)\d\d?:\d\d:\d\d(\.\d*)?'
+    r'\s*(Z|[-+]\d\d?(:\d\d)?)?\s*(\.\.\.\s*)?$')
 
 
 # http://code.activestate.com/recipes/541096-prompt-the-user-for-confirmation/
@@ -64,13 +73,22 @@ def serialize_date(date_obj):
 
 
 def deserialize_date(date_str):
-    """Deserialize a datetime object from plain text."""
+    """
+    Deserialize a datetime object from plain text, or return None if the
+    text is not a serialized date.
+    """
+    if not date_str or not SERIALIZED_DATE_RE.match(date_str):
+        return None
+
     def timestamp_constructor(loader, node):
         """A better YAML datetime parser that is timezone aware."""
         return dateutil.parser.parse(node.value)
 
     yaml.add_constructor(u'tag:yaml.org,2002:timestamp', timestamp_constructor)
-    loaded_data = yaml.load(date_str)
+    try:
+        loaded_data = yaml.load(date_str)
+    except yaml.YAMLError:
+        return None
     if isinstance(loaded_data, datetime.datetime):
         return loaded_data
     else:
@@ -100,14 +118,36 @@ def parse_datetime(date_string):
                                             minute=0,
                                             second=0,
                                             microsecond=0)
-    if os.environ.get('HABIT_TZ'):
-        localtz = pytz.timezone(os.environ.get('HABIT_TZ'))
-    else:
-        localtz = get_localzone()
-    aware_dt = localtz.localize(unaware_dt)
+    aware_dt = get_local_timezone().localize(unaware_dt)
     return aware_dt
 
 
+def parse_date_range(date_string):
+    """
+    Parse a natural language date into a (start, end) pair. A date without
+    a time covers its whole day, ending at the start of the next; a date
+    with a time is a single instant, with an end of None.
+    """
+    cal = Calendar()
+    parsed = cal.nlp(date_string)
+    if not parsed:
+        raise DateParseException("Date '%s' unclear" % date_string)
+    unaware_dt, code = parsed[0][0], parsed[0][1]
+    localtz = get_local_timezone()
+    if code != 1:
+        return localtz.localize(unaware_dt), None
+    start = unaware_dt.replace(hour=0, minute=0, second=0, microsecond=0)
+    return (localtz.localize(start),
+            localtz.localize(start + datetime.timedelta(days=1)))
+
+
+def get_local_timezone():
+    """Return the timezone from $HABIT_TZ, or else the system one."""
+    if os.environ.get('HABIT_TZ'):
+        return pytz.timezone(os.environ.get('HABIT_TZ'))
+    return get_localzone()
+
+
 def is_past(datetimeobj):
     """Returns True if the given date is in the past."""
     if not datetimeobj:
@@ -126,7 +166,30 @@ def get_default_config_filename():
     return os.path.join(os.path.expanduser("~"), ".habitrc")
 
 
-def read_config(config_filename=None):
+def get_config_section(profile=None):
+    """Return the config file section holding the given profile."""
+    return 'HabitRPG:%s' % profile if profile else 'HabitRPG'
+
+
+def list_profiles(config_filename=None):
+    """
+    Return the profile names in the config file. The default [HabitRPG]
+    section is listed as None, and [HabitRPG:name] sections by name.
+    """
+    if not config_filename:
+        config_filename = get_default_config_filename()
+    config = ConfigParser.SafeConfigParser()
+    config.read(config_filename)
+    profiles = []
+    for section in config.sections():
+        if section == 'HabitRPG':
+            profiles.append(None)
+        elif section.startswith('HabitRPG:'):
+            profiles.append(section.split(':', 1)[1])
+    return profiles
+
+
+def read_config(config_filename=None, profile=None):
     """Read the configuration file and return the results."""
     config_dict = {}
 
@@ -138,7 +201,7 @@ def read_config(config_filename=None):
     # If the config file does not exist, try to fetch the config details from
     # the environment; if that fails, write the default config file. Otherwise,
     # read the values from the config file (which may have just been written).
-    if not os.path.exists(config_filename):
+    if not os.path.exists(config_filename) and not profile:
         if 'HABIT_USER_ID' in os.environ.keys() and \
                 'HABIT_API_KEY' in os.environ.keys() and \
                 'HABIT_TASKS' in os.environ.keys():
@@ -153,7 +216,7 @@ def read_config(config_filename=None):
             write_default_config_file(config_filename)
 
     config.read(config_filename)
-    for key, value in config.items('HabitRPG'):
+    for key, value in config.items(get_config_section(profile)):
         config_dict[key] = value
     # Expand comma-separated string of tasks into list
     task_str = config_dict['tasks']
@@ -177,15 +240,116 @@ def write_default_config_file(config_filename=None):
     config.set('HabitRPG', 'user_id', '-1')
     config.set('HabitRPG', 'api_key', '-1')
     config.set('HabitRPG', 'tasks', 'morning,afternoon,evening')
+    config.set('HabitRPG', 'timeout', '30')
     with open(config_filename, 'wb') as config_file:
         config.write(config_file)
 
 
-def save_user(user):
-    """Save the user object to a file."""
-    pickle.dump(user, open(os.path.join(CACHE_DIR, ".habit.p"), 'wb'))
+def get_config_mtime(config_filename=None):
+    """Return the modification time of the config file, or None."""
+    if not config_filename:
+        config_filename = get_default_config_filename()
+    try:
+        return os.path.getmtime(config_filename)
+    except OSError:
+        return None
+
+
+def get_cache_filename(name, profile=None):
+    """
+    Return the path of a cache file such as '.habit.p'. Each profile other
+    than the default gets its own files, e.g. '.habit-work.p'.
+    """
+    if profile:
+        name = name.replace('.habit', '.habit-%s' % profile, 1)
+    return os.path.join(CACHE_DIR, name)
+
+
+def save_user(user, profile=None):
+    """Save the user object to a file and return the sha1 of its pickle."""
+    data = pickle.dumps(user, pickle.HIGHEST_PROTOCOL)
+    # Write a temporary file and rename it, so a reader never sees a
+    # partial pickle
+    filename = get_cache_filename(".habit.p", profile)
+    with open(filename + ".tmp", 'wb') as user_file:
+        user_file.write(data)
+    os.rename(filename + ".tmp", filename)
+    return hashlib.sha1(data).hexdigest()
 
 
-def load_user():
+def load_user(profile=None):
     """Load the user object from the cache."""
-    return pickle.load(open(os.path.join(CACHE_DIR, ".habit.p"), 'rb'))
+    return pickle.load(open(get_cache_filename(".habit.p", profile), 'rb'))
+
+
+def get_user_cache_stat(profile=None):
+    """Return the (mtime, size) of the cached user, or None."""
+    try:
+        stat = os.stat(get_cache_filename(".habit.p", profile))
+    except OSError:
+        return None
+    return (stat.st_mtime, stat.st_size)
+
+
+def save_snapshot(snapshot, profile=None):
+    """Save the derived-state snapshot of the user and config."""
+    filename = get_cache_filename(".habit_snapshot.p", profile)
+    with open(filename + ".tmp", 'wb') as snapshot_file:
+        pickle.dump(snapshot, snapshot_file, pickle.HIGHEST_PROTOCOL)
+    os.rename(filename + ".tmp", filename)
+
+
+def load_snapshot(profile=None):
+    """Load the derived-state snapshot, or None if there is none."""
+    try:
+        with open(get_cache_filename(".habit_snapshot.p", profile),
+                  'rb') as snapshot_file:
+            return pickle.load(snapshot_file)
+    except Exception:  # pylint: disable=broad-except
+        return None
+
+
+def save_archive(todos, profile=None):
+    """Save the archived (completed) todos to their own cache file."""
+    filename = get_cache_filename(".habit_archive.p", profile)
+    with open(filename + ".tmp", 'wb') as archive_file:
+        pickle.dump(todos, archive_file, pickle.HIGHEST_PROTOCOL)
+    os.rename(filename + ".tmp", filename)
+
+
+def archive_hash(todos):
+    """Hash the content of the archived todos."""
+    return hashlib.sha1(json.dumps(todos, sort_keys=True)).hexdigest()
+
+
+def has_archive(profile=None):
+    """Check whether the archived todos have been saved."""
+    return os.path.exists(get_cache_filename(".habit_archive.p", profile))
+
+
+def load_archive(profile=None):
+    """Load the archived todos, or an empty list if there are none."""
+    try:
+        with open(get_cache_filename(".habit_archive.p", profile),
+                  'rb') as archive_file:
+            return pickle.load(archive_file)
+    except (IOError, EOFError):
+        return []
+
+
+def save_search_index(index, profile=None):
+    """Save the full-text search index."""
+    filename = get_cache_filename(".habit_search.p", profile)
+    with open(filename + ".tmp", 'wb') as index_file:
+        pickle.dump(index, index_file, pickle.HIGHEST_PROTOCOL)
+    os.rename(filename + ".tmp", filename)
+
+
+def load_search_index(profile=None):
+    """Load the full-text search index, or None if there is none."""
+    try:
+        with open(get_cache_filename(".habit_search.p", profile),
+                  'rb') as index_file:
+            return pickle.load(index_file)
+    except Exception:  # pylint: disable=broad-except
+        return None
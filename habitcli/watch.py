@@ -0,0 +1,48 @@
+"""Helpers for long-running views that redraw in place."""
+
+import os
+import sys
+import tempfile
+
+import colors
+
+
+def redraw(old_lines, new_lines, stream=None):
+    """
+    Redraw a block of lines previously written to a terminal, rewriting only
+    the lines that changed.
+
+    'old_lines' is what was last drawn (empty on the first draw). Returns
+    'new_lines', to be passed back in on the next call.
+    """
+    stream = stream if stream else sys.stdout
+    if not old_lines:
+        stream.write("\n".join(new_lines) + "\n")
+    else:
+        # Move the cursor back up to the first line of the block
+        stream.write("\x1b[%dA" % len(old_lines))
+        for index, line in enumerate(new_lines):
+            if index < len(old_lines) and old_lines[index] == line:
+                stream.write("\n")
+            else:
+                stream.write("\r\x1b[2K" + line + "\n")
+        # Clear any lines left over from a longer block, then move back up
+        # so the cursor ends just below the new block
+        leftover = len(old_lines) - len(new_lines)
+        if leftover > 0:
+            stream.write("\x1b[2K\n" * leftover)
+            stream.write("\x1b[%dA" % leftover)
+    stream.flush()
+    return new_lines
+
+
+def write_atomic(filename, text):
+    """
+    Replace a file's contents atomically, so readers polling it never see a
+    partial write. Terminal color codes are stripped.
+    """
+    directory = os.path.dirname(os.path.abspath(filename))
+    handle, temp_filename = tempfile.mkstemp(dir=directory)
+    with os.fdopen(handle, 'w') as temp_file:
+        temp_file.write(colors.strip_color(text))
+    os.rename(temp_filename, filename)
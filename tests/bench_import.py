@@ -0,0 +1,53 @@
+"""
+Benchmark bulk import throughput (todos/sec) against a local fake server.
+
+Run with `python -m tests.bench_import [num_todos] [latency] [throttle_every]`,
+where every 'throttle_every'-th request is answered with a 429.
+"""
+
+import json
+import os
+import shutil
+import sys
+import tempfile
+
+TEMP_DIR = tempfile.mkdtemp()
+os.environ['HABIT_CACHE_DIR'] = TEMP_DIR
+
+import habitcli
+from habitcli.importer import TodoImporter, read_records
+from tests.fake_server import start_server, write_config, TASKS
+
+
+def main():
+    """Import the same file with increasing worker counts."""
+    num_todos = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    latency = float(sys.argv[2]) if len(sys.argv) > 2 else 0.02
+    throttle_every = int(sys.argv[3]) if len(sys.argv) > 3 else 0
+
+    server = start_server(latency=latency, throttle_every=throttle_every)
+    config_filename = os.path.join(TEMP_DIR, 'habitrc')
+    write_config(config_filename, server)
+    hcli = habitcli.HabitCLI(config_filename)
+
+    records_filename = os.path.join(TEMP_DIR, 'todos.ndjson')
+    with open(records_filename, 'w') as records:
+        for index in range(num_todos):
+            records.write(json.dumps({'text': 'Imported %d' % index,
+                                      'tags': [TASKS[index % len(TASKS)]],
+                                      'due': 'tomorrow'}) + "\n")
+
+    print "%d todos, %.0fms simulated latency" % (num_todos, latency * 1000)
+    try:
+        for workers in [1, 4, 8, 16]:
+            importer = TodoImporter(hcli, workers=workers, rate=1000)
+            summary = importer.run(read_records(records_filename))
+            print "%2d workers: %7.1f todos/sec (%d failed)" % \
+                (workers, summary['created'] / summary['elapsed'],
+                 len(summary['failed']))
+    finally:
+        server.shutdown()
+        shutil.rmtree(TEMP_DIR)
+
+if __name__ == '__main__':
+    main()
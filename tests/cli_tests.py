@@ -1,5 +1,6 @@
 from nose.tools import *
 import habitcli
+import habitcli.complete
 
 class HabitTest:
     def setup(self):
@@ -36,3 +37,508 @@ class HabitTest:
         dt_obj = habitcli.parse_datetime_from_date_str(date_str)
 
         print "I RAN!"
+
+
+def test_deserialize_date_ignores_text():
+    from habitcli.utils import deserialize_date
+    assert_equals(deserialize_date("Call Bob: re: invoice"), None)
+    assert_equals(deserialize_date("- [x"), None)
+    assert_equals(deserialize_date(""), None)
+
+
+def test_parse_retry_after():
+    from habitcli.ratelimit import parse_retry_after
+    assert_equals(parse_retry_after("3"), 3.0)
+    assert_equals(parse_retry_after(None), None)
+
+
+def test_limiter_aimd():
+    from habitcli.ratelimit import AdaptiveLimiter
+    limiter = AdaptiveLimiter(rate=1000, max_concurrency=8)
+    limiter.acquire()
+    limiter.release(throttled=True)
+    assert_equals(limiter.limit, 4.0)
+    limiter.acquire()
+    limiter.release()
+    assert_equals(limiter.limit, 4.25)
+
+
+def test_limiter_released_on_error():
+    from habitcli.ratelimit import AdaptiveLimiter, send_with_retries
+
+    def send():
+        raise IOError("Could not write the cassette")
+    limiter = AdaptiveLimiter(rate=1000, max_concurrency=1)
+    for _ in range(2):
+        assert_raises(IOError, send_with_retries, limiter, send, 'post')
+    assert_equals(limiter.in_flight, 0)
+
+
+def test_request_timeout():
+    from requests import ConnectionError
+    from habitcli.ratelimit import ThrottledHabitAPI
+    from tests.fake_server import start_server
+    server = start_server(latency=1.0)
+    try:
+        api = ThrottledHabitAPI('fake', 'fake', base_url=server.url,
+                                max_retries=0, timeout=0.1)
+        assert_raises(ConnectionError, api.user)
+        assert_equals(api.limiter.in_flight, 0)
+    finally:
+        server.shutdown()
+
+
+def test_stats_history():
+    import shutil
+    import tempfile
+    from habitcli.history import StatsHistory
+    directory = tempfile.mkdtemp()
+    try:
+        history = StatsHistory(directory)
+        stats = {'hp': 50, 'mp': 30, 'exp': 10, 'gp': 1.5, 'lvl': 3}
+        for minute in range(180):
+            history.append(dict(stats, exp=minute), 997200 + minute * 60)
+        assert_equals(len(history.query(997200, 997200 + 599)), 10)
+        # Three hours of minutes fall back to the hourly tier
+        hourly = history.query(0, 2000000, max_points=10)
+        assert_equals([sample[3] for sample in hourly], [59, 119, 179])
+    finally:
+        shutil.rmtree(directory)
+
+
+def test_json_projection():
+    from habitcli.jsonstream import project
+    doc = '{"items": {"a": [1, "}"]}, "stats": {"hp": 50}, "todos": []}'
+    chunks = [doc[i:i + 7] for i in range(0, len(doc), 7)]
+    assert_equals(project(chunks, ['stats', 'todos']),
+                  {'stats': {'hp': 50}, 'todos': []})
+
+
+def test_query():
+    import os
+    from habitcli.query import TodoIndex, compile_query, run_query
+    todos = [habitcli.Todo(id=str(i), text="Task %d" % i, notes="",
+                           date="2014-01-%02dT12:00:00Z" % (i + 1),
+                           tags={'work': i % 2 == 0, 'home': i % 2 == 1},
+                           checklist=[{'text': 'a', 'completed': i < 5}])
+             for i in range(10)]
+    index = TodoIndex(todos)
+    old_tz = os.environ.get('HABIT_TZ')
+    try:
+        # Bare dates cover a whole local day, whatever the timezone
+        for timezone in ['America/Los_Angeles', 'UTC', 'Asia/Tokyo']:
+            os.environ['HABIT_TZ'] = timezone
+            query = compile_query(['+work', 'due<2014-01-06',
+                                   'checklist:complete', 'text~task'],
+                                  lambda name: [name])
+            expected = ['0', '2', '4']
+            assert_equals([t['id'] for t in run_query(query, todos, index)],
+                          expected)
+            assert_equals([t['id'] for t in run_query(query, todos)],
+                          expected)
+            query = compile_query(['work', 'home', 'due<2014-01-03'],
+                                  lambda name: [name])
+            assert_equals([t['id'] for t in run_query(query, todos, index)],
+                          ['0', '1'])
+            query = compile_query(['due<=2014-01-02'], lambda name: [name])
+            assert_equals([t['id'] for t in run_query(query, todos)],
+                          ['0', '1'])
+            query = compile_query(['due>2014-01-09'], lambda name: [name])
+            assert_equals([t['id'] for t in run_query(query, todos, index)],
+                          ['9'])
+    finally:
+        if old_tz is None:
+            del os.environ['HABIT_TZ']
+        else:
+            os.environ['HABIT_TZ'] = old_tz
+    # A tag name that resolves to no tag is an error, negated or not
+    assert_raises(ValueError, compile_query, ['-typo'], lambda name: [])
+
+
+def test_search_index():
+    from habitcli.search import SearchIndex
+    todos = [{'id': '1', 'text': 'Deploy script', 'notes': 'run the deploy'},
+             {'id': '2', 'text': 'Buy milk', 'notes': '', 'completed': True},
+             {'id': '3', 'text': 'Write docs about deploy', 'notes': ''}]
+    index = SearchIndex()
+    assert_equals(index.sync(todos), True)
+    assert_equals(index.sync(todos), False)
+    assert_equals([r[1] for r in index.search('deploy')], ['1', '3'])
+    assert_equals(index.sync(todos[1:]), True)
+    assert_equals([r[1] for r in index.search('deploy')], ['3'])
+
+
+def test_search_leaves_archive_unloaded():
+    import shutil
+    import tempfile
+    from habitcli.search import update_search_index
+    directory = tempfile.mkdtemp()
+    old_directory = use_cache_dir(directory)
+    try:
+        update_search_index([{'id': '1', 'text': 'Deploy script',
+                              'notes': '', 'completed': True}])
+        hcli = habitcli.HabitCLI.__new__(habitcli.HabitCLI)
+        hcli.profile = None
+        hcli.api = object()
+        hcli.user = {'todos': []}
+        hcli.get_archived_todos = None
+        assert_equals([r[1] for r in hcli.get_search_results('deploy')],
+                      ['1'])
+    finally:
+        use_cache_dir(old_directory)
+        shutil.rmtree(directory)
+
+
+def test_batch_coalesces_updates():
+    class FakeAPI(object):
+        def __init__(self):
+            self.calls = []
+
+        def update_task(self, task_id, task):
+            self.calls.append(task_id)
+            return task
+    hcli = habitcli.HabitCLI.__new__(habitcli.HabitCLI)
+    hcli.pending_updates = None
+    hcli.api = FakeAPI()
+    todo = habitcli.Todo(id='1', text='a', notes='', hcli=hcli)
+    with hcli.batch():
+        todo['text'] = 'b'
+        todo.update_db()
+        todo['notes'] = 'c'
+        todo.update_db()
+        assert_equals(hcli.api.calls, [])
+    assert_equals(hcli.api.calls, ['1'])
+    assert_equals(todo['text'], 'b')
+
+
+def test_change_feed_diff():
+    from habitcli.changes import EMPTY_STATE, diff_sync
+    stats = {'hp': 50, 'mp': 30, 'exp': 10, 'gp': 1.0, 'lvl': 3}
+    todos = [{'id': '1', 'text': 'a', 'notes': ''},
+             {'id': '2', 'text': 'b', 'notes': ''}]
+    state, _ = diff_sync(EMPTY_STATE, todos, stats)
+    state, event = diff_sync(state, todos, stats)
+    assert_equals(event, None)
+    todos = [{'id': '1', 'text': 'a', 'notes': 'x'},
+             {'id': '3', 'text': 'c', 'notes': '', 'completed': True}]
+    state, event = diff_sync(state, todos, dict(stats, exp=15))
+    assert_equals(event['added'], [{'id': '3', 'text': 'c'}])
+    assert_equals(event['deleted'], [{'id': '2', 'text': 'b'}])
+    assert_equals(event['changed'][0]['fields'], {'notes': ['', 'x']})
+    assert_equals(event['stats'], {'exp': 5})
+    # Archived todos keep only their hash, and a reopened one reports that
+    assert_equals(sorted(state['todos']), ['1'])
+    todos[1] = dict(todos[1], completed=False)
+    _, event = diff_sync(state, todos, stats)
+    assert_equals(event['changed'], [{'id': '3', 'text': 'c',
+                                      'fields': {'completed': [True, False]}}])
+
+
+def test_check_response():
+    from habitcli.asyncapi import check_response
+    from habitcli.exceptions import HabitAPIError
+
+    class FakeResponse(object):
+        status_code = 404
+        reason = 'Not Found'
+
+        def json(self):
+            return {'err': 'Not found'}
+    assert_raises(HabitAPIError, check_response, FakeResponse())
+    FakeResponse.status_code = 200
+    check_response(FakeResponse())
+
+
+def test_candidate_pairs():
+    from habitcli import dedupe
+    todos = [{'text': 'Buy milk'}, {'text': 'buy the milk'},
+             {'text': 'Buy eggs'}, {'text': 'Buy milk'}]
+    tags = ['home', 'home', 'home', 'work']
+    assert_equals(dedupe.candidate_pairs(todos, tags),
+                  [(0, 1), (0, 2), (1, 2)])
+    # Blocks over the size limit are skipped: only 'milk' pairs remain
+    old_size = dedupe.MAX_BLOCK_SIZE
+    dedupe.MAX_BLOCK_SIZE = 2
+    try:
+        assert_equals(dedupe.candidate_pairs(todos, tags), [(0, 1)])
+    finally:
+        dedupe.MAX_BLOCK_SIZE = old_size
+
+
+def test_find_duplicates():
+    from habitcli.dedupe import find_duplicates
+    todos = [{'text': 'Buy milk today', 'dateCreated': '2014-01-02'},
+             {'text': 'File taxes', 'dateCreated': '2014-01-01'},
+             {'text': 'today buy milk', 'dateCreated': '2014-01-01'},
+             {'text': 'Milk today buy', 'dateCreated': '2014-01-03',
+              'checklist': [{'text': 'skim'}]}]
+    # The reorderings form one cluster, keeping the todo with a checklist
+    # first, then the oldest
+    clusters = find_duplicates(todos, ['home'] * 4)
+    assert_equals(clusters, [[(3, 100), (2, 100), (0, 100)]])
+
+
+class FakeTodo(dict):
+    """A todo with fixed plan and due dates, for the reminder queue."""
+    def get_planning_date(self):
+        return self['plan']
+
+    def get_due_date(self):
+        return None
+
+
+def test_reminder_queue_skips_stale():
+    import datetime
+    from habitcli.query import to_timestamp
+    from habitcli.remind import ReminderQueue
+    first = datetime.datetime(2014, 1, 1, 12, 0)
+    second = datetime.datetime(2014, 1, 2, 12, 0)
+    now = to_timestamp(first) - 60
+    queue = ReminderQueue()
+    todo = FakeTodo(id='1', text='a', plan=first)
+    assert_equals(queue.sync([todo], now), 1)
+    # Moving the date and moving it back leaves two stale heap items
+    # behind, and the reminder fires once
+    todo['plan'] = second
+    queue.sync([todo], now)
+    todo['plan'] = first
+    queue.sync([todo], now)
+    assert_equals(queue.next_time(), to_timestamp(first))
+    assert_equals(len(queue.pop_due(to_timestamp(second))), 1)
+    assert_equals(queue.next_time(), None)
+
+
+def test_anonymizer():
+    from habitcli.cassette import Anonymizer
+    plan = "2014-01-02 03:04:05\n...\n"
+    user = {'auth': {'local': {'email': 'me@example.com'}},
+            'tags': [{'id': 't1', 'name': 'work'}],
+            'todos': [{'text': 'Call Bob: invoice', 'notes': plan},
+                      {'text': 'Call Bob: invoice', 'notes': 'Ask Alice'}]}
+    anonymized = Anonymizer(keep=['work']).value(user)
+    assert_equals(sorted(anonymized), ['tags', 'todos'])
+    assert_equals(anonymized['tags'], user['tags'])
+    first, second = anonymized['todos']
+    assert_equals(first['notes'], plan)
+    assert first['text'] != user['todos'][0]['text']
+    assert_equals([len(word) for word in first['text'].split()], [4, 4, 7])
+    assert_equals(first['text'][8], ':')
+    assert_equals(second['text'], first['text'])
+    assert second['notes'] != 'Ask Alice'
+
+
+def use_cache_dir(directory):
+    """Point the habitcli caches at a directory, returning the old one."""
+    old_directory = habitcli.utils.CACHE_DIR
+    habitcli.utils.CACHE_DIR = directory
+    habitcli.complete.CACHE_DIR = directory
+    return old_directory
+
+
+def test_import_rejected_todo():
+    import os
+    import shutil
+    import tempfile
+    from habitcli.importer import TodoImporter
+    from tests.fake_server import start_server, write_config
+    server = start_server(reject_creates=True)
+    directory = tempfile.mkdtemp()
+    old_directory = use_cache_dir(directory)
+    try:
+        config_filename = os.path.join(directory, 'habitrc')
+        write_config(config_filename, server)
+        hcli = habitcli.HabitCLI(config_filename)
+        importer = TodoImporter(
+            hcli, checkpoint_filename=os.path.join(directory, 'checkpoint'))
+        summary = importer.run([(1, {'text': 'Rejected', 'tags': 'morning'})])
+        assert_equals(summary['created'], 0)
+        assert_equals([line for line, _ in summary['failed']], [1])
+        # A rejected todo is not checkpointed, so a rerun tries it again
+        assert_equals(importer.load_checkpoint(), set())
+    finally:
+        use_cache_dir(old_directory)
+        server.shutdown()
+        shutil.rmtree(directory)
+
+
+def render_terminal(text):
+    """Replay the cursor-up, erase-line and newline codes of redraw."""
+    import re
+    rows, row = [], 0
+    for token in re.findall(r'\x1b\[\d*[AK]|\r|\n|[^\x1b\r\n]+', text):
+        while len(rows) <= row:
+            rows.append('')
+        if token == '\n':
+            row += 1
+        elif token.endswith('A'):
+            row -= int(token[2:-1])
+        elif token.endswith('K'):
+            rows[row] = ''
+        elif token != '\r':
+            rows[row] += token
+    return rows, row
+
+
+def test_redraw_shrinking_block():
+    from StringIO import StringIO
+    from habitcli.watch import redraw
+    stream = StringIO()
+    drawn = redraw([], ['(Cached)', 'HP', 'MP', 'XP'], stream)
+    drawn = redraw(drawn, ['HP', 'MP', 'XP'], stream)
+    drawn = redraw(drawn, ['HP2', 'MP', 'XP'], stream)
+    rows, row = render_terminal(stream.getvalue())
+    assert_equals(rows[:3], ['HP2', 'MP', 'XP'])
+    assert_equals(rows[3:], [''] * (len(rows) - 3))
+    assert_equals(row, 3)
+
+
+def test_archive_follows_completed_edits():
+    import os
+    import shutil
+    import tempfile
+    from habitcli.search import get_search_index
+    from habitcli.utils import load_archive
+    from tests.fake_server import make_user, start_server, write_config
+    user = make_user(2)
+    user['todos'][1]['completed'] = True
+    server = start_server(user)
+    directory = tempfile.mkdtemp()
+    old_directory = use_cache_dir(directory)
+    try:
+        config_filename = os.path.join(directory, 'habitrc')
+        write_config(config_filename, server)
+        habitcli.HabitCLI(config_filename)
+        # Editing a completed todo keeps the archived IDs the same
+        user['todos'][1]['notes'] = 'invoice'
+        habitcli.HabitCLI(config_filename)
+        assert_equals(load_archive()[0]['notes'], 'invoice')
+        assert_equals([r[1] for r in get_search_index().search('invoice')],
+                      [user['todos'][1]['id']])
+    finally:
+        use_cache_dir(old_directory)
+        server.shutdown()
+        shutil.rmtree(directory)
+
+
+def test_unknown_profile():
+    import os
+    import shutil
+    import tempfile
+    directory = tempfile.mkdtemp()
+    old_directory = use_cache_dir(directory)
+    try:
+        config_filename = os.path.join(directory, 'habitrc')
+        with open(config_filename, 'w') as config_file:
+            config_file.write("[HabitRPG:work]\nuser_id = fake\n"
+                              "api_key = fake\ntasks = morning:red\n")
+        assert_raises(SystemExit, habitcli.HabitCLI, config_filename,
+                      profile='typo')
+    finally:
+        use_cache_dir(old_directory)
+        shutil.rmtree(directory)
+
+
+class CountingHabitCLI(habitcli.HabitCLI):
+    """A HabitCLI that counts the users it builds rather than restores."""
+    builds = 0
+
+    def _build_user(self, raw_user):
+        CountingHabitCLI.builds += 1
+        habitcli.HabitCLI._build_user(self, raw_user)
+
+
+def start_profile(directory, **kwargs):
+    """Start a fake server and write a config for it in 'directory'."""
+    import os
+    from tests.fake_server import make_user, start_server, write_config
+    server = start_server(make_user(3), **kwargs)
+    config_filename = os.path.join(directory, 'habitrc')
+    write_config(config_filename, server)
+    with open(config_filename, 'a') as config_file:
+        config_file.write("startup_deadline = 0.2\n")
+    return server, config_filename
+
+
+def test_warm_start_restores_snapshot():
+    import shutil
+    import tempfile
+    directory = tempfile.mkdtemp()
+    old_directory = use_cache_dir(directory)
+    server, config_filename = start_profile(directory)
+    try:
+        CountingHabitCLI.builds = 0
+        CountingHabitCLI(config_filename)
+        assert_equals(CountingHabitCLI.builds, 1)
+        # An unchanged user is restored from the snapshot
+        hcli = CountingHabitCLI(config_filename)
+        assert_equals(CountingHabitCLI.builds, 1)
+        assert_equals(len(hcli.user['todos']), 3)
+        assert_equals(hcli.user['cached'], False)
+        # A changed one is rebuilt
+        server.user['todos'][0]['text'] = 'Changed'
+        hcli = CountingHabitCLI(config_filename)
+        assert_equals(CountingHabitCLI.builds, 2)
+        assert_equals(sorted(todo['text'] for todo in hcli.user['todos'])[0],
+                      'Changed')
+    finally:
+        use_cache_dir(old_directory)
+        server.shutdown()
+        shutil.rmtree(directory)
+
+
+def test_slow_start_uses_cache_and_saves_late():
+    import shutil
+    import tempfile
+    import time
+    from habitcli.utils import load_user
+    directory = tempfile.mkdtemp()
+    old_directory = use_cache_dir(directory)
+    server, config_filename = start_profile(directory)
+    try:
+        CountingHabitCLI.builds = 0
+        CountingHabitCLI(config_filename)
+        server.user['todos'][0]['text'] = 'Changed'
+        server.latency = 1.0
+        started = time.time()
+        hcli = CountingHabitCLI(config_filename, read_only=True)
+        # The deadline passed, so the cache was restored from the snapshot
+        # matching its file
+        assert time.time() - started < 0.9
+        assert_equals(hcli.user['cached'], True)
+        assert_equals(CountingHabitCLI.builds, 1)
+        assert 'Changed' not in [todo['text'] for todo in hcli.user['todos']]
+        # The fetch finishes in the background and refreshes the cache
+        deadline = time.time() + 5
+        while time.time() < deadline:
+            if load_user()['todos'][0]['text'] == 'Changed':
+                break
+            time.sleep(0.1)
+        assert_equals(load_user()['todos'][0]['text'], 'Changed')
+        # Commands that change todos wait for the server instead
+        hcli = CountingHabitCLI(config_filename)
+        assert_equals(hcli.user['cached'], False)
+    finally:
+        use_cache_dir(old_directory)
+        server.shutdown()
+        shutil.rmtree(directory)
+
+
+def test_start_with_server_down():
+    import shutil
+    import tempfile
+    directory = tempfile.mkdtemp()
+    old_directory = use_cache_dir(directory)
+    server, config_filename = start_profile(directory)
+    try:
+        habitcli.HabitCLI(config_filename)
+        server.shutdown()
+        server.server_close()
+        hcli = habitcli.HabitCLI(config_filename)
+        assert_equals(hcli.user['cached'], True)
+        assert_equals(len(hcli.user['todos']), 3)
+        # Without a cache there is nothing to fall back to
+        use_cache_dir(tempfile.mkdtemp(dir=directory))
+        assert_raises(SystemExit, habitcli.HabitCLI, config_filename)
+    finally:
+        use_cache_dir(old_directory)
+        shutil.rmtree(directory)
@@ -0,0 +1,149 @@
+"""A minimal in-process fake of the HabitRPG API for benchmarks and tests."""
+
+import BaseHTTPServer
+import json
+import SocketServer
+import threading
+import time
+import urlparse
+import uuid
+
+
+TASKS = ['morning', 'afternoon', 'evening']
+
+
+def make_user(num_todos=0):
+    """Build a fake user document with a few tags and todos."""
+    tags = [{'id': str(uuid.uuid4()), 'name': name} for name in TASKS]
+    todos = []
+    for index in range(num_todos):
+        todos.append({'id': str(uuid.uuid4()),
+                      'type': 'todo',
+                      'text': 'Fake todo %d' % index,
+                      'notes': '',
+                      'completed': False,
+                      'tags': {tags[index % len(tags)]['id']: True}})
+    stats = {'hp': 50, 'maxHealth': 50, 'mp': 30, 'maxMP': 30,
+             'exp': 0, 'toNextLevel': 150, 'gp': 0, 'lvl': 1}
+    return {'id': str(uuid.uuid4()), 'tags': tags, 'todos': todos,
+            'habits': [], 'dailys': [], 'stats': stats}
+
+
+class ThreadingHTTPServer(SocketServer.ThreadingMixIn,
+                          BaseHTTPServer.HTTPServer):
+    """An HTTP server that handles each request in its own thread."""
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        """Ignore clients that time out and hang up mid-reply."""
+        pass
+
+
+class FakeHabitHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Serve the subset of the API used by habitcli."""
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def _body(self):
+        """Decode a JSON or form-encoded request body."""
+        length = int(self.headers.get('Content-Length') or 0)
+        raw = self.rfile.read(length) if length else ''
+        try:
+            return json.loads(raw)
+        except ValueError:
+            return dict((key, values[-1]) for key, values
+                        in urlparse.parse_qs(raw).items())
+
+    def _reply(self, payload, status=200):
+        """Send a JSON response."""
+        body = json.dumps(payload)
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _handle(self, method):
+        """Route a request after the configured latency."""
+        server = self.server
+        time.sleep(server.latency)
+        with server.lock:
+            server.requests += 1
+            count = server.requests
+        if server.throttle_every and count % server.throttle_every == 0:
+            self.send_response(429)
+            self.send_header('Retry-After', '0')
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+
+        path = urlparse.urlparse(self.path).path.rstrip('/')
+        parts = path.split('/')
+        user = server.user
+
+        if method == 'GET' and parts[-1] == 'user':
+            self._reply(user)
+        elif method == 'POST' and parts[-1] in ('up', 'down'):
+            self._reply(dict(user['stats'], _tmp={}))
+        elif method == 'POST' and parts[-1] in ('task', 'tasks') and \
+                server.reject_creates:
+            self._reply({'err': 'Task validation failed'}, 400)
+        elif method == 'POST' and parts[-1] in ('task', 'tasks'):
+            task = self._body()
+            task['id'] = str(uuid.uuid4())
+            task.setdefault('completed', False)
+            with server.lock:
+                user['todos'].append(task)
+            self._reply(task)
+        elif method == 'PUT':
+            task = self._body()
+            task['id'] = parts[-1]
+            self._reply(task)
+        elif method == 'DELETE':
+            self._reply({})
+        else:
+            self._reply({'err': 'Not found'}, 404)
+
+    def do_GET(self):
+        self._handle('GET')
+
+    def do_POST(self):
+        self._handle('POST')
+
+    def do_PUT(self):
+        self._handle('PUT')
+
+    def do_DELETE(self):
+        self._handle('DELETE')
+
+
+def start_server(user=None, latency=0.0, throttle_every=0,
+                 reject_creates=False):
+    """
+    Start a fake server in a background thread and return it. With
+    'reject_creates', new tasks are refused with a 400 error.
+    """
+    server = ThreadingHTTPServer(('127.0.0.1', 0), FakeHabitHandler)
+    server.user = user if user else make_user()
+    server.latency = latency
+    server.throttle_every = throttle_every
+    server.reject_creates = reject_creates
+    server.requests = 0
+    server.lock = threading.Lock()
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    server.url = 'http://127.0.0.1:%d/' % server.server_address[1]
+    return server
+
+
+def write_config(filename, server):
+    """Write a habitrc pointing at the fake server."""
+    with open(filename, 'w') as config_file:
+        config_file.write("[HabitRPG]\n"
+                          "user_id = fake\n"
+                          "api_key = fake\n"
+                          "tasks = morning:red,afternoon:green,evening:blue\n"
+                          "api_url = %s\n" % server.url)